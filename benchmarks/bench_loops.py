@@ -0,0 +1,56 @@
+import argparse
+import timeit
+
+import unplate
+
+"""
+
+Benchmark rendering a large table with a template builder loop,
+with and without Options.lower_loops.
+
+  python3 -m benchmarks.bench_loops --rows 1000000
+
+"""
+
+code = """#newline
+def render(rows):
+  [unplate.begin(table)]
+  # <table>
+  # >>> for key, value in rows:
+    # <tr><td>{{ key }}</td><td>{{ value }}</td></tr>
+  # <<<
+  # </table>
+  [unplate.end]
+  return table
+"""
+
+
+def compile_render(lower_loops):
+  options = unplate.options.Options()
+  options.lower_loops = lower_loops
+  namespace = {}
+  exec(unplate.compile_anon(code, options), namespace)
+  return namespace['render']
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--rows', type=int, default=1_000_000)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  rows = [(f'key{i}', i) for i in range(args.rows)]
+
+  results = {}
+  for lower_loops in [False, True]:
+    render = compile_render(lower_loops)
+    best = min(timeit.repeat(lambda: render(rows), number=1, repeat=args.repeat))
+    results[lower_loops] = best
+    print(f"lower_loops={lower_loops!s:5}  {best * 1000:10.1f} ms  ({args.rows / best:,.0f} rows/sec)")
+
+  assert compile_render(False)(rows[:100]) == compile_render(True)(rows[:100])
+  print(f"speedup: {results[False] / results[True]:.2f}x")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,355 @@
+import argparse
+import gc
+import json
+import string
+import sys
+import timeit
+import tracemalloc
+
+import unplate
+
+"""
+
+Render-throughput benchmarks: code compiled by Unplate against
+hand-written Python doing the same job.
+
+  python3 -m benchmarks.bench_render
+  python3 -m benchmarks.bench_render --save baseline.json
+  python3 -m benchmarks.bench_render --compare baseline.json
+
+Each workload is rendered by each implementation. For each, reports
+
+  ops/sec    renders per second (best of --repeat runs)
+  peak KiB   peak memory allocated during one render, via tracemalloc
+  retained   net memory blocks still allocated after one render (including
+             the result), via sys.getallocatedblocks(). This is not the
+             number of allocations made while rendering, which CPython
+             does not count
+
+Before timing, every implementation of a workload is checked to give the
+same output. With --compare, exits with status 1 if any Unplate
+implementation got slower than in the saved results by more than
+--tolerance.
+
+"""
+
+
+# Unplate configurations to benchmark
+variants = {
+  'unplate': {},
+  'unplate lower_loops': {'lower_loops': True},
+  'unplate rope': {'builder_output': 'rope'},
+  'unplate metrics': {'metrics': True},
+}
+
+
+templates = """#newline
+def namecard(name):
+  greeting = unplate.template(
+    # /------------------------\\
+    # |   Hello, my name is:   |
+    # |  {{ name.ljust(20) }}  |
+    # \\------------------------/
+  )
+  return greeting
+
+
+def table(rows):
+  [unplate.begin(result)]
+  # <table>
+  # >>> for key, value in rows:
+    # <tr><td>{{ key }}</td><td>{{ value }}</td></tr>
+  # <<<
+  # </table>
+  [unplate.end]
+  return result
+
+
+def nested(sections):
+  [unplate.begin(result)]
+  # >>> for title, groups in sections:
+    # <section><h1>{{ title }}</h1>
+    # >>> for group in groups:
+      # <ul>
+      # >>> for item in group:
+        # <li>{{ item }}</li>
+      # <<<
+      # </ul>
+    # <<<
+    # </section>
+  # <<<
+  [unplate.end]
+  return result
+
+
+def tree(node):
+  label, children = node
+  [unplate.begin(result)]
+  # <li>{{ label }}
+  # >>> if children:
+    # <ul>
+    # >>> for child in children:
+      # {{ tree(child) }}
+    # <<<
+    # </ul>
+  # <<<
+  # </li>
+  [unplate.end]
+  return result
+"""
+
+
+def compile_templates(**option_values):
+  options = unplate.options.Options()
+  for name, value in option_values.items():
+    setattr(options, name, value)
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_code(templates, options, file_loc='<benchmarks>'), namespace)
+  return namespace
+
+
+# Hand-written implementations.
+# Each must give exactly the same output as the Unplate templates above.
+
+def namecard_fstring(name):
+  return f"""/------------------------\\
+|   Hello, my name is:   |
+|  {name.ljust(20)}  |
+\\------------------------/
+"""
+
+def namecard_join(name):
+  return ''.join(['/------------------------\\\n|   Hello, my name is:   |\n|  ', str(name.ljust(20)), '  |\n\\------------------------/\n'])
+
+namecard_template = string.Template('/------------------------\\\n|   Hello, my name is:   |\n|  $name  |\n\\------------------------/\n')
+def namecard_string_template(name):
+  return namecard_template.substitute(name=name.ljust(20))
+
+def namecard_percent(name):
+  return '/------------------------\\\n|   Hello, my name is:   |\n|  %s  |\n\\------------------------/\n' % (name.ljust(20),)
+
+
+def table_fstring(rows):
+  return '<table>\n' + ''.join([f'<tr><td>{key}</td><td>{value}</td></tr>\n' for key, value in rows]) + '</table>\n'
+
+def table_join(rows):
+  result = ['<table>\n']
+  for key, value in rows:
+    result.append(''.join(['<tr><td>', str(key), '</td><td>', str(value), '</td></tr>\n']))
+  result.append('</table>\n')
+  return ''.join(result)
+
+row_template = string.Template('<tr><td>$key</td><td>$value</td></tr>\n')
+def table_string_template(rows):
+  return '<table>\n' + ''.join([row_template.substitute(key=key, value=value) for key, value in rows]) + '</table>\n'
+
+def table_percent(rows):
+  return '<table>\n' + ''.join(['<tr><td>%s</td><td>%s</td></tr>\n' % (key, value) for key, value in rows]) + '</table>\n'
+
+
+def nested_fstring(sections):
+  result = []
+  for title, groups in sections:
+    result.append(f'<section><h1>{title}</h1>\n')
+    for group in groups:
+      result.append('<ul>\n' + ''.join([f'<li>{item}</li>\n' for item in group]) + '</ul>\n')
+    result.append('</section>\n')
+  return ''.join(result)
+
+def nested_join(sections):
+  result = []
+  for title, groups in sections:
+    result.append(''.join(['<section><h1>', str(title), '</h1>\n']))
+    for group in groups:
+      result.append('<ul>\n')
+      for item in group:
+        result.append(''.join(['<li>', str(item), '</li>\n']))
+      result.append('</ul>\n')
+    result.append('</section>\n')
+  return ''.join(result)
+
+section_template = string.Template('<section><h1>$title</h1>\n')
+item_template = string.Template('<li>$item</li>\n')
+def nested_string_template(sections):
+  result = []
+  for title, groups in sections:
+    result.append(section_template.substitute(title=title))
+    for group in groups:
+      result.append('<ul>\n' + ''.join([item_template.substitute(item=item) for item in group]) + '</ul>\n')
+    result.append('</section>\n')
+  return ''.join(result)
+
+def nested_percent(sections):
+  result = []
+  for title, groups in sections:
+    result.append('<section><h1>%s</h1>\n' % (title,))
+    for group in groups:
+      result.append('<ul>\n' + ''.join(['<li>%s</li>\n' % (item,) for item in group]) + '</ul>\n')
+    result.append('</section>\n')
+  return ''.join(result)
+
+
+def tree_fstring(node):
+  label, children = node
+  if children:
+    inner = ''.join([f'{tree_fstring(child)}\n' for child in children])
+    return f'<li>{label}\n<ul>\n{inner}</ul>\n</li>\n'
+  return f'<li>{label}\n</li>\n'
+
+def tree_join(node):
+  label, children = node
+  result = [''.join(['<li>', str(label), '\n'])]
+  if children:
+    result.append('<ul>\n')
+    for child in children:
+      result.append(''.join([str(tree_join(child)), '\n']))
+    result.append('</ul>\n')
+  result.append('</li>\n')
+  return ''.join(result)
+
+tree_open_template = string.Template('<li>$label\n')
+def tree_string_template(node):
+  label, children = node
+  result = [tree_open_template.substitute(label=label)]
+  if children:
+    result.append('<ul>\n')
+    for child in children:
+      result.append(tree_string_template(child) + '\n')
+    result.append('</ul>\n')
+  result.append('</li>\n')
+  return ''.join(result)
+
+def tree_percent(node):
+  label, children = node
+  if children:
+    inner = ''.join(['%s\n' % (tree_percent(child),) for child in children])
+    return '<li>%s\n<ul>\n%s</ul>\n</li>\n' % (label, inner)
+  return '<li>%s\n</li>\n' % (label,)
+
+
+def make_tree(depth, breadth, label='node'):
+  if depth == 0:
+    return (label, [])
+  return (label, [make_tree(depth - 1, breadth, f'{label}.{i}') for i in range(breadth)])
+
+
+def workloads(scale):
+  """ Return {workload name: (argument, {implementation name: function})} """
+
+  rows = [(f'key{i}', i) for i in range(10_000 * scale)]
+  sections = [
+    (f'section {s}', [[f'item {s}.{g}.{i}' for i in range(10)] for g in range(10)])
+    for s in range(10 * scale)
+  ]
+  tree = make_tree(depth=6, breadth=3 + scale)
+
+  baselines = {
+    'namecard': ('Unplate', namecard_fstring, namecard_join, namecard_string_template, namecard_percent),
+    'table': (rows, table_fstring, table_join, table_string_template, table_percent),
+    'nested': (sections, nested_fstring, nested_join, nested_string_template, nested_percent),
+    'tree': (tree, tree_fstring, tree_join, tree_string_template, tree_percent),
+  }
+
+  compiled = {variant: compile_templates(**option_values) for variant, option_values in variants.items()}
+
+  result = {}
+  for name, (argument, fstring, join, template, percent) in baselines.items():
+    implementations = {variant: namespace[name] for variant, namespace in compiled.items()}
+    # flatten Ropes once, at the top, as a caller would
+    for variant, option_values in variants.items():
+      if option_values.get('builder_output') == 'rope':
+        implementations[variant] = lambda argument, render=implementations[variant]: str(render(argument))
+    implementations.update({
+      'f-string': fstring,
+      'str.join': join,
+      'string.Template': template,
+      '%-format': percent,
+    })
+    result[name] = (argument, implementations)
+
+  return result
+
+
+def check_outputs(workload, argument, implementations):
+  """ Assert that all implementations of a workload give the same output """
+  expected = implementations['f-string'](argument)
+  for name, function in implementations.items():
+    assert function(argument) == expected, f"{workload}: {name} gives different output"
+
+
+def measure(function, argument, repeat):
+  """ Return (ops/sec, peak bytes, retained blocks) for rendering function(argument) """
+
+  timer = timeit.Timer(lambda: function(argument))
+  number, _ = timer.autorange()
+  best = min(timer.repeat(repeat=repeat, number=number)) / number
+
+  gc.collect()
+  gc.disable()
+  try:
+    blocks_before = sys.getallocatedblocks()
+    result = function(argument)
+    retained = sys.getallocatedblocks() - blocks_before
+    del result
+  finally:
+    gc.enable()
+
+  tracemalloc.start()
+  try:
+    function(argument)
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+
+  return 1 / best, peak, retained
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Unplate render benchmarks')
+  parser.add_argument('--scale', type=int, default=1, help='multiply workload sizes')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--only', nargs='*', help='only run these workloads')
+  parser.add_argument('--save', help='save results to this JSON file')
+  parser.add_argument('--compare', help='compare against results saved with --save')
+  parser.add_argument('--tolerance', type=float, default=0.10, help='allowed slowdown for --compare')
+  args = parser.parse_args()
+
+  results = {}
+  for workload, (argument, implementations) in workloads(args.scale).items():
+    if args.only and workload not in args.only:
+      continue
+
+    check_outputs(workload, argument, implementations)
+
+    print(f"\n{workload}")
+    print(f"  {'implementation':22} {'ops/sec':>12} {'peak KiB':>10} {'retained':>8}")
+    for name, function in implementations.items():
+      ops, peak, retained = measure(function, argument, args.repeat)
+      results[f'{workload}/{name}'] = {'ops': ops, 'peak': peak, 'retained': retained}
+      print(f"  {name:22} {ops:12,.1f} {peak / 1024:10,.1f} {retained:8,}")
+
+  if args.save:
+    with open(args.save, 'w') as f:
+      json.dump(results, f, indent=2)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+
+    regressions = [
+      f"{key}: {baseline[key]['ops']:,.1f} -> {result['ops']:,.1f} ops/sec"
+      for key, result in results.items()
+      if key.split('/')[1] in variants and key in baseline
+      and result['ops'] < baseline[key]['ops'] * (1 - args.tolerance)
+    ]
+
+    print()
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      sys.exit(1)
+    print(f"no regressions against {args.compare}")
+
+
+if __name__ == '__main__':
+  main()
@@ -1,3 +1,11 @@
+import ast
+import builtins
+import importlib.util
+import io
+import os
+import subprocess
+import sys
+
 import pytest
 import unplate
 
@@ -58,6 +66,21 @@ assert t == s + '\\n'
   exec(unplate.compile_anon(code))
 
 
+def test__adjacent_interpolations():
+
+  # the character right after '}}' used to be skipped
+  code = """#newline
+a, b = 'A', 'B'
+t = unplate.template(
+  # {{ a }}{{ b }}|{{ a }}x
+)
+"""
+
+  namespace = {}
+  exec(unplate.compile_anon(code), namespace)
+  assert namespace['t'] == 'AB|Ax\n'
+
+
 def test__stmt_interpolation():
 
   code = """#newline
@@ -223,3 +246,1124 @@ not `unplate.template`.
 
   with pytest.raises(AttributeError):
     exec(unplate.compile_anon(code))
+
+
+def test__bytes_output():
+
+  options = unplate.options.Options()
+  options.output_bytes = True
+
+  code = """#newline
+name = 'wörld'
+literal = unplate.template(
+  # hello {{ name }}
+  # static
+)
+assert literal == 'hello wörld\\nstatic\\n'.encode('utf-8'), literal
+
+[unplate.begin(builder)]
+# >>> for i in range(2):
+  # {{ i }}: é
+# <<<
+[unplate.end]
+assert builder == '0: é\\n1: é\\n'.encode('utf-8'), builder
+"""
+
+  compiled = unplate.compile_anon(code, options)
+  # static text is encoded at compile time
+  assert "str (name ).encode ('utf-8')" in compiled
+  assert "b'''\nstatic\n'''" in compiled
+  exec(compiled)
+
+
+@pytest.mark.parametrize('builder_output', ['joined', 'chunks', 'rope'])
+@pytest.mark.parametrize('lower_loops', [False, True])
+def test__bytes_composed(builder_output, lower_loops):
+
+  options = unplate.options.Options()
+  options.output_bytes = True
+  options.builder_output = builder_output
+  options.lower_loops = lower_loops
+
+  code = """#newline
+def bold(text):
+  return unplate.template(
+    # <b>{{ text }}</b>
+  )
+
+def div(text):
+  return unplate.template(
+    # <div>{{ bold(text) }}</div>
+  )
+
+[unplate.begin(page)]
+# >>> for text in ['x', b'y']:
+  # {{ div(text) }}{{ text }}
+# <<<
+[unplate.end]
+"""
+
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_anon(code, options), namespace)
+  assert namespace['div']('x') == b'<div><b>x</b>\n</div>\n'
+
+  page = namespace['page']
+  page = b''.join(page) if builder_output == 'chunks' else bytes(page)
+  assert page == b'<div><b>x</b>\n</div>\nx\n<div><b>y</b>\n</div>\ny\n', page
+
+
+def test__builder_chunks_output():
+
+  options = unplate.options.Options()
+  options.output_bytes = True
+  options.builder_output = 'chunks'
+
+  code = """#newline
+[unplate.begin(builder)]
+# <ul>
+# >>> for i in range(2):
+  # <li>{{ i }}</li>
+# <<<
+# </ul>
+[unplate.end]
+assert builder == [b'<ul>\\n', b'<li>', b'0', b'</li>\\n', b'<li>', b'1', b'</li>\\n', b'</ul>\\n'], builder
+"""
+
+  exec(unplate.compile_anon(code, options))
+
+  # typos are not silently accepted
+  options.builder_output = 'chunk'
+  with pytest.raises(ValueError):
+    unplate.compile_anon(code, options)
+
+
+def test__import_time():
+
+  # `import unplate` should not load the compiler (or the tokenizer)
+  # until something is actually compiled
+  budget_us = 10_000
+
+  result = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', 'import sys, unplate; print(sorted(sys.modules))'],
+    capture_output=True, text=True, check=True,
+    # wherever unplate is imported from here
+    cwd=os.path.dirname(os.path.dirname(unplate.__file__)),
+  )
+
+  loaded = result.stdout
+  for module in ['unplate.compile', 'unplate.options', 'unplate.tokenize_util', 'tokenize']:
+    assert repr(module) not in loaded, module
+
+  # lines look like 'import time:  self [us] | cumulative | name'
+  timings = {}
+  for line in result.stderr.splitlines()[1:]:
+    self_us, cumulative_us, name = line.split(':', 1)[1].split('|')
+    timings[name.strip()] = int(cumulative_us)
+  assert timings['unplate'] < budget_us, timings['unplate']
+
+
+def test__default_delimiter_tables():
+
+  # The default delimiters are written out by hand; check them against the tokenizer
+  options = unplate.options.Options()
+
+  literal_open, literal_close = tku.split_pattern(tku.tokenize_expr('unplate.template(\nBODY)'), 'BODY')
+  builder_open_left, builder_open_right = tku.split_pattern(tku.tokenize_expr('[unplate.begin(NAME)]'), 'NAME')
+  builder_close = tku.tokenize_expr('[unplate.end]')
+
+  def strings(tokens):
+    return [(tok.type, tok.string) for tok in tokens]
+
+  assert strings(options.template_literal_open) == strings(literal_open)
+  assert strings(options.template_literal_close) == strings(literal_close)
+  assert strings(options.template_builder_open_left) == strings(builder_open_left)
+  assert strings(options.template_builder_open_right) == strings(builder_open_right)
+  assert strings(options.template_builder_close) == strings(builder_close)
+
+
+def test__region_cache():
+
+  template = """#newline
+one = unplate.template(
+  # first {{ x }}
+)
+[unplate.begin(two)]
+# >>> for i in range(3):
+  # second {{ i }}
+# <<<
+[unplate.end]
+"""
+
+  cache = unplate.reload.RegionCache()
+
+  compiled = unplate.compile_code(template, file_loc='<test>', cache=cache)
+  assert compiled == unplate.compile_anon(template)
+  assert (cache.hits, cache.misses) == (0, 2)
+
+  # edit only the builder
+  edited = template.replace('second', 'changed')
+  compiled = unplate.compile_code(edited, file_loc='<test>', cache=cache)
+  assert compiled == unplate.compile_anon(edited)
+  assert (cache.hits, cache.misses) == (1, 3)
+
+  # different options do not share entries
+  options = unplate.options.Options()
+  options.output_bytes = True
+  unplate.compile_code(edited, options, file_loc='<test>', cache=cache)
+  assert (cache.hits, cache.misses) == (1, 5)
+
+
+def test__watcher_reloads(tmp_path):
+
+  source = """#newline
+import unplate
+if unplate.true:
+  exec(unplate.compile(__file__), globals(), locals())
+else:
+  greeting = unplate.template(
+    # hello
+  )
+"""
+
+  file_loc = tmp_path / 'watched_module.py'
+  file_loc.write_text(source)
+
+  spec = importlib.util.spec_from_file_location('watched_module', file_loc)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  assert module.greeting == 'hello\n'
+
+  watcher = unplate.reload.Watcher([module])
+  assert watcher.poll() == []
+
+  file_loc.write_text(source.replace('hello', 'goodbye'))
+  stat = os.stat(file_loc)
+  os.utime(file_loc, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+  assert watcher.poll() == [module]
+  assert module.greeting == 'goodbye\n'
+
+
+def test__include():
+
+  code = """#newline
+cell = 'x'
+[unplate.begin(row)]
+# <td>{{ cell }}</td>
+[unplate.end]
+
+[unplate.begin(table)] @ '''
+<table>
+>>> for cell in ['a', 'b']:
+  >>> include row
+<<<
+</table>
+''' [unplate.end]
+
+assert table == '<table>\\n  <td>a</td>\\n  <td>b</td>\\n</table>\\n', repr(table)
+"""
+
+  compiled = unplate.compile_anon(code)
+  # the partial is inlined, not called
+  assert compiled.count("'</td>\\n'") == 2
+  exec(compiled)
+
+
+def test__include_blocks():
+
+  code = """#newline
+def partials():
+  [unplate.begin(row)]
+  # >>> if cells:
+    # <tr>
+  # <<<
+  # >>> for cell in cells:
+    # <td>{{ cell }}</td>
+  # <<<
+  # </tr>
+  [unplate.end]
+
+def table(rows):
+  [unplate.begin(result)]
+  # >>> for cells in rows:
+    # >>> include row
+  # <<<
+  # >>> raise ValueError(''.join(result))
+  [unplate.end]
+"""
+
+  python_code = unplate.compile_anon(code)
+  assert python_code.count('\n') == code.count('\n')
+
+  namespace = {}
+  exec(builtins.compile(python_code, 'table.py', 'exec'), namespace)
+  with pytest.raises(ValueError) as info:
+    namespace['table']([[1, 2], []])
+  assert str(info.value) == '<tr>\n<td>1</td>\n<td>2</td>\n</tr>\n</tr>\n'
+  # the line of the raise, as the include takes up a single line
+  assert info.traceback[-1].lineno + 1 == 18
+
+  # blocks which cannot go on one line
+  nested = code.replace("# >>> if cells:", "# >>> if cells:\n    # >>> for cell in cells:\n      # x\n    # <<<")
+  with pytest.raises(unplate.UnplateSyntaxError):
+    unplate.compile_anon(nested)
+
+
+def test__include_undefined():
+
+  code = """#newline
+[unplate.begin(template)]
+# >>> include not_yet_defined
+[unplate.end]
+
+[unplate.begin(not_yet_defined)]
+# text
+[unplate.end]
+"""
+
+  with pytest.raises(unplate.UnplateSyntaxError):
+    unplate.compile_anon(code)
+
+
+def test__region_cache_include():
+
+  template = """#newline
+[unplate.begin(partial)]
+# partial
+[unplate.end]
+[unplate.begin(whole)]
+# >>> include partial
+[unplate.end]
+"""
+
+  cache = unplate.reload.RegionCache()
+  unplate.compile_code(template, file_loc='<test>', cache=cache)
+
+  # changing the partial must recompile the template including it
+  edited = template.replace('# partial', '# edited')
+  compiled = unplate.compile_code(edited, file_loc='<test>', cache=cache)
+  assert compiled == unplate.compile_anon(edited)
+  assert (cache.hits, cache.misses) == (0, 4)
+
+
+def test__lower_loops():
+
+  code = """#newline
+rows = [('a', 1), ('b', 2)]
+[unplate.begin(template)]
+# <table>
+# >>> for name, value in rows:
+  # <tr>{{ name }}</tr>
+  # <td>{{ value }}</td>
+# <<<
+# >>> for x in 1, 2:
+  # {{ x }}
+# <<<
+# >>> for x in []:
+  # never
+# <<<
+# >>> else:
+  # else
+# <<<
+# </table>
+[unplate.end]
+"""
+
+  options = unplate.options.Options()
+  options.lower_loops = True
+  compiled = unplate.compile_anon(code, options)
+
+  # only the first loop can be lowered
+  assert compiled.count('.extend (') == 1
+  assert len(compiled.splitlines()) == len(unplate.compile_anon(code).splitlines())
+
+  expected = {}
+  exec(unplate.compile_anon(code), expected)
+  lowered = {}
+  exec(compiled, lowered)
+  assert lowered['template'] == expected['template'], lowered['template']
+
+
+def test__tracing(tmp_path):
+
+  source = """#newline
+import unplate
+if unplate.true:
+  exec(unplate.compile(__file__), globals(), locals())
+else:
+  literal = unplate.template(
+    # hello
+  )
+
+  [unplate.begin(builder)]
+  # one
+  # two
+  [unplate.end]
+"""
+
+  file_loc = tmp_path / 'traced.py'
+  file_loc.write_text(source)
+
+  events = []
+  with unplate.trace.tracing(events.append):
+    unplate.compile(str(file_loc))
+  unplate.compile(str(file_loc))
+
+  [event] = events
+  assert event.file_loc == str(file_loc)
+  assert list(event.stages) == ['read', 'tokenize', 'compile_top', 'replace_sublist', 'untokenize', 'builtins.compile']
+  assert (event.template_literals, event.template_builders) == (1, 1)
+
+  literal, builder = event.regions
+  assert (literal.kind, literal.name, literal.lineno, literal.lines) == ('literal', None, 6, 3)
+  assert (builder.kind, builder.name, builder.lineno, builder.lines) == ('builder', 'builder', 10, 4)
+  assert event.as_dict()['regions'][1]['tokens'] == builder.tokens
+
+
+def test__fold_constants():
+
+  options = unplate.options.Options()
+  options.fold_constants = True
+  options.constants = {'WIDTH': 10}
+
+  code = """#newline
+name = 'x'
+template = unplate.template(
+  # {{ '-' * WIDTH }}
+  # {{ '{:>4}|'.format('ab') }}{{ name }}{{ 1 + 2 }}%
+  # {{ 'z' * 10 ** 10 }}
+)
+"""
+
+  compiled = unplate.compile_anon(code, options)
+  assert "'----------" in compiled
+  assert "str (name )" in compiled
+  # too big to fold, and left as it was
+  assert "str ('z'*10 **10 )" in compiled.replace(' * ', '*')
+  assert 'WIDTH' not in compiled
+
+  # check the folded values render the same as unfolded ones
+  small = code.replace("'z' * 10 ** 10", "'z' * 3")
+  folded = {}
+  exec(unplate.compile_anon(small, options), folded)
+  unfolded = {'WIDTH': 10}
+  exec(unplate.compile_anon(small), unfolded)
+  assert folded['template'] == unfolded['template'] == '----------\n  ab|x3%\nzzz\n'
+
+  # widths and precisions are checked before formatting, not after
+  unplate_compile = unplate.load('compile')
+  for expr in [
+    "'{:>1000000000}'.format('a')",
+    "'{0:>{w}}'.format('a', w='1000000000')",
+    "f\"{'a':>1000000000}\"",
+    "'%1000000000s' % 'a'",
+    "'%.1000000000f' % 1.0",
+    "('x' * 4000).replace('x', 'y' * 4000)",
+  ]:
+    with pytest.raises(unplate_compile.NotConstant):
+      unplate_compile.evaluate_constant(ast.parse(expr, mode='eval').body, {})
+
+
+def test__options_key_unhashable():
+
+  class Config:
+    __hash__ = None
+
+  options = unplate.options.Options()
+  options.fold_constants = True
+  options.constants = {'TAGS': {'a', 'b'}, 'CONFIG': Config()}
+
+  same = unplate.options.Options()
+  same.fold_constants = True
+  same.constants = {'TAGS': {'b', 'a'}, 'CONFIG': options.constants['CONFIG']}
+  assert options.key() == same.key()
+  hash(options.key())
+
+  # sets are not confused with tuples, nor other objects with each other
+  same.constants['TAGS'] = ('a', 'b')
+  assert options.key() != same.key()
+  same.constants['TAGS'] = {'a', 'b'}
+  same.constants['CONFIG'] = Config()
+  assert options.key() != same.key()
+
+  code = """#newline
+template = unplate.template(
+  # {{ sorted(TAGS) }}
+)
+"""
+
+  # compiles, whether or not the set is folded
+  namespace = {'TAGS': {'a', 'b'}}
+  exec(unplate.compile_anon(code, options), namespace)
+  assert namespace['template'] == "['a', 'b']\n"
+
+
+def test__minify():
+
+  options = unplate.options.Options()
+  options.minify = True
+
+  code = """#newline
+name = 'a  b'
+[unplate.begin(page)] @ '''
+  <div   class="x">
+
+    <p>   {{ name }}   </p>
+    <pre>  keep
+
+   this </pre>   <b> x </b>
+  </div>
+''' [unplate.end]
+
+[unplate.begin(builder)]
+# <ul>
+# >>> for i in range(2):
+  #     <li>   {{ i }}</li>
+# <<<
+# </ul>
+[unplate.end]
+
+literal = unplate.template(
+  #     <p>   {{ name }}   </p>
+)
+
+after = 'line'
+"""
+
+  compiled = unplate.compile_anon(code, options)
+  assert len(compiled.splitlines()) == len(unplate.compile_anon(code).splitlines())
+
+  namespace = {}
+  exec(compiled, namespace)
+  assert namespace['page'] == '<div class="x">\n<p> a  b </p>\n<pre>  keep\n\n   this </pre> <b> x </b>\n</div>\n', namespace['page']
+  assert namespace['builder'] == '<ul>\n<li> 0</li>\n<li> 1</li>\n</ul>\n', namespace['builder']
+  assert namespace['literal'] == '<p> a  b </p>\n', namespace['literal']
+
+  # nor is whitespace in attribute values, even around interpolations and across lines
+  namespace = {'x': 1}
+  exec(unplate.compile_anon("""#newline
+t = unplate.template(
+  #   <input   value="a    b"  title='{{ x }}  it"s '>  don't   <a   href="
+  #    c  ">   x   </a>
+)
+""", options), namespace)
+  assert namespace['t'] == """<input value="a    b" title='1  it"s '> don't <a href="\n   c  "> x </a>\n""", namespace['t']
+
+  # no-break spaces are not insignificant whitespace
+  namespace = {}
+  exec(unplate.compile_anon("#newline\nt = unplate.template(\n  # \u00a0a \u00a0\u00a0 b\u00a0\n)\n", options), namespace)
+  assert namespace['t'] == '\u00a0a \u00a0\u00a0 b\u00a0\n'
+
+
+def test__benchmark_implementations_agree():
+
+  # the benchmarks compare like with like
+  from benchmarks import bench_render
+
+  for workload, (argument, implementations) in bench_render.workloads(scale=1).items():
+    bench_render.check_outputs(workload, argument, implementations)
+
+
+def test__nested_builders():
+
+  code = """#newline
+rows = [[1, 2], [3]]
+[unplate.begin(table)]
+# <table>
+# >>> for row in rows:
+  # >>> [unplate.begin(cells)]
+  # >>> for cell in row:
+    # <td>{{ cell }}</td>
+  # <<<
+  # >>> [unplate.end]
+  # <tr>{{ cells }}</tr>
+# <<<
+# >>> [unplate.begin(footer)]
+# foot
+# >>> [unplate.end]
+# {{ footer }}{{ footer }}
+# </table>
+[unplate.end]
+"""
+
+  compiled = unplate.compile_anon(code)
+
+  # cells is only interpolated once, so writes straight into table.
+  # footer is used twice, so gets its own list.
+  assert 'cells' not in compiled
+  assert 'footer =[]' in compiled
+
+  namespace = {}
+  exec(compiled, namespace)
+  assert namespace['table'] == (
+    '<table>\n<tr><td>1</td>\n<td>2</td>\n</tr>\n<tr><td>3</td>\n</tr>\nfoot\nfoot\n\n</table>\n'
+  ), namespace['table']
+
+
+def test__nested_builder_used_later():
+
+  code = """#newline
+[unplate.begin(outer)]
+# >>> [unplate.begin(inner)]
+# text
+# >>> [unplate.end]
+# {{ inner }}
+[unplate.end]
+assert inner == 'text\\n'
+assert outer == 'text\\n\\n'
+"""
+
+  compiled = unplate.compile_anon(code)
+  assert 'inner =[]' in compiled
+  exec(compiled)
+
+
+def test__nested_builder_unclosed():
+
+  code = """#newline
+[unplate.begin(outer)]
+# >>> [unplate.begin(inner)]
+# text
+[unplate.end]
+"""
+
+  with pytest.raises(unplate.UnplateSyntaxError):
+    unplate.compile_anon(code)
+
+
+def test__nested_builder_control_flow():
+
+  code = """#newline
+[unplate.begin(table)]
+# >>> for i in range(3):
+  # >>> [unplate.begin(cells)]
+  # >>> if i == 1:
+    # >>> continue
+  # <<<
+  # a{{ i }}
+  # >>> [unplate.end]
+  # <tr>{{ cells }}</tr>
+# <<<
+[unplate.end]
+"""
+
+  # fusing would write '<tr>' before the continue
+  compiled = unplate.compile_anon(code)
+  assert 'cells =[]' in compiled
+
+  namespace = {}
+  exec(compiled, namespace)
+  assert namespace['table'] == '<tr>a0\n</tr>\n<tr>a2\n</tr>\n', namespace['table']
+
+
+def test__nested_builder_used_above():
+
+  code = """#newline
+def count():
+  return len(cells)
+[unplate.begin(outer)]
+# >>> [unplate.begin(cells)]
+# text
+# >>> [unplate.end]
+# {{ cells }}
+[unplate.end]
+assert count() == len('text\\n')
+"""
+
+  compiled = unplate.compile_anon(code)
+  assert 'cells =[]' in compiled
+  exec(compiled, {})
+
+
+@pytest.mark.parametrize('output_bytes, builder_output, expected', [
+  (True, 'joined', b'foot\nfoot\n\n'),
+  (False, 'chunks', ['foot\n', 'foot\n', '\n']),
+  (True, 'chunks', [b'foot\n', b'foot\n', b'\n']),
+])
+def test__nested_builder_output_types(output_bytes, builder_output, expected):
+
+  options = unplate.options.Options()
+  options.output_bytes = output_bytes
+  options.builder_output = builder_output
+
+  code = """#newline
+[unplate.begin(page)]
+# >>> [unplate.begin(footer)]
+# foot
+# >>> [unplate.end]
+# {{ footer }}{{ footer }}
+[unplate.end]
+"""
+
+  namespace = {}
+  exec(unplate.compile_anon(code, options), namespace)
+  assert namespace['page'] == expected, namespace['page']
+
+
+def test__region_cache_nested_builder():
+
+  template = """#newline
+[unplate.begin(outer)]
+# >>> [unplate.begin(inner)]
+# text
+# >>> [unplate.end]
+# {{ inner }}
+[unplate.end]
+"""
+
+  cache = unplate.reload.RegionCache()
+  unplate.compile_code(template, file_loc='<test>', cache=cache)
+
+  # now inner is used after the template, so cannot be fused into outer
+  edited = template + "print(inner)\n"
+  compiled = unplate.compile_code(edited, file_loc='<test>', cache=cache)
+  assert compiled == unplate.compile_anon(edited)
+  assert 'inner =[]' in compiled
+
+
+def test__rope_output():
+
+  options = unplate.options.Options()
+  options.builder_output = 'rope'
+
+  code = """#newline
+def render(node):
+  label, children = node
+  [unplate.begin(result)]
+  # <li>{{ label }}
+  # >>> for child in children:
+    # {{ render(child) }}
+  # <<<
+  # </li>
+  [unplate.end]
+  return result
+
+tree = ('a', [('b', []), ('c', [('d', [])])])
+rope = render(tree)
+"""
+
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_anon(code, options), namespace)
+  rope = namespace['rope']
+
+  expected = '<li>a\n<li>b\n</li>\n\n<li>c\n<li>d\n</li>\n\n</li>\n\n</li>\n'
+  assert isinstance(rope, unplate.rope.Rope)
+  # children are kept, not copied
+  assert any(isinstance(part, unplate.rope.Rope) for part in rope.parts)
+  assert str(rope) == rope == expected
+  assert len(rope) == len(expected)
+
+  sink = io.StringIO()
+  rope.write(sink)
+  assert sink.getvalue() == expected
+
+
+def test__rope_deep():
+
+  # flattening is not recursive
+  rope = unplate.rope.Rope(['leaf'])
+  for _ in range(sys.getrecursionlimit() * 2):
+    rope = unplate.rope.Rope(['<', rope, '>'])
+  assert str(rope).count('leaf') == 1
+
+
+def test__rope_bytes():
+
+  options = unplate.options.Options()
+  options.builder_output = 'rope'
+  options.output_bytes = True
+
+  code = """#newline
+[unplate.begin(inner)]
+# é
+[unplate.end]
+[unplate.begin(outer)]
+# {{ inner }}{{ 1 }}
+[unplate.end]
+"""
+
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_anon(code, options), namespace)
+  assert bytes(namespace['outer']) == 'é\n1\n'.encode('utf-8')
+
+
+@pytest.mark.parametrize('lower_loops', [False, True])
+def test__rope_evaluation_order(lower_loops):
+
+  options = unplate.options.Options()
+  options.builder_output = 'rope'
+  options.lower_loops = lower_loops
+
+  code = """#newline
+calls = []
+def bump():
+  calls.append(len(calls))
+  return len(calls)
+[unplate.begin(out)]
+# >>> for _ in range(2):
+  # {{ len(calls) }} {{ bump() }}
+# <<<
+[unplate.end]
+"""
+
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_anon(code, options), namespace)
+  assert str(namespace['out']) == '0 1\n1 2\n'
+  assert namespace['calls'] == [0, 1]
+
+  sink = []
+  namespace['out'].write(type('Sink', (), {'write': staticmethod(sink.append)}))
+  assert sink == ['0', ' ', '1', '\n', '1', ' ', '2', '\n']
+
+
+def test__metrics():
+
+  options = unplate.options.Options()
+  options.metrics = True
+
+  code = """#newline
+def page(items):
+  header = unplate.template(
+    # <h1>{{ len(items) }} items</h1>
+  )
+  [unplate.begin(result)]
+  # {{ header }}
+  # >>> for item in items:
+    # <li>{{ item }}</li>
+  # <<<
+  [unplate.end]
+  return result
+
+def other():
+  [unplate.begin(result)]
+  # other
+  [unplate.end]
+  return result
+
+first = page(['a', 'b'])
+second = page([])
+other()
+"""
+
+  registry = unplate.metrics.registry
+  registry.reset()
+
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_code(code, options, file_loc='page.py'), namespace)
+  assert namespace['first'] == '<h1>2 items</h1>\n\n<li>a</li>\n<li>b</li>\n'
+
+  metrics = registry.as_dict()
+  # builders of the same name are told apart by their line
+  assert set(metrics) == {'page.py:result (line 6)', 'page.py:result (line 15)', 'page.py:line 3'}
+  assert metrics['page.py:result (line 15)']['renders'] == 1
+  builder = metrics['page.py:result (line 6)']
+  assert builder['renders'] == metrics['page.py:line 3']['renders'] == 2
+  assert builder['size']['sum'] == len(namespace['first']) + len(namespace['second'])
+  assert sum(builder['latency']['counts']) == 2
+
+  exposition = registry.prometheus()
+  assert '# TYPE unplate_render_seconds histogram' in exposition
+  assert 'unplate_render_size_bucket{file="page.py",template="result (line 6)",le="+Inf"} 2\n' in exposition
+  assert 'unplate_render_seconds_count{file="page.py",template="line 3"} 2\n' in exposition
+
+  # memory is bounded
+  registry.reset()
+  registry.maxsize = 1
+  try:
+    registry.observe(('a.py', 'a'), unplate.metrics.clock(), 'x')
+    registry.observe(('b.py', 'b'), unplate.metrics.clock(), 'y')
+    assert set(registry.as_dict()) == {'a.py:a', '<other>:<other>'}
+  finally:
+    registry.maxsize = 10_000
+    registry.reset()
+
+
+def test__single_flight_threads(tmp_path, monkeypatch):
+
+  import threading
+  import time
+
+  file_locs = []
+  for i in range(3):
+    file_loc = tmp_path / f'module{i}.py'
+    file_loc.write_text(f"[unplate.begin(result)]\n# module {i}\n[unplate.end]\n")
+    file_locs.append(str(file_loc))
+
+  compiled = []
+  compile_code = unplate.compile_code
+  def counting_compile_code(code, options=None, **kwargs):
+    compiled.append(kwargs['file_loc'])
+    time.sleep(0.05)  # so that the other threads arrive mid-compilation
+    return compile_code(code, options, **kwargs)
+
+  monkeypatch.setattr(unplate, 'compile_code', counting_compile_code)
+  monkeypatch.setattr(unplate.coordinator, 'coordinator', unplate.coordinator.Coordinator())
+
+  barrier = threading.Barrier(24)
+  results = {}
+  def worker(n):
+    barrier.wait()
+    for file_loc in file_locs:
+      namespace = {}
+      exec(unplate.compile(file_loc), namespace)
+      results[n, file_loc] = namespace['result']
+
+  threads = [threading.Thread(target=worker, args=(n,)) for n in range(24)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert sorted(compiled) == sorted(file_locs)
+  assert results[0, file_locs[2]] == 'module 2\n'
+  assert len(set(results.values())) == 3
+
+  # editing a file recompiles it
+  time.sleep(0.01)
+  with open(file_locs[0], 'a') as f:
+    f.write('\n')
+  unplate.compile(file_locs[0])
+  assert compiled.count(file_locs[0]) == 2
+
+
+def test__single_flight_same_stamp(tmp_path):
+
+  file_loc = tmp_path / 'page.py'
+  file_loc.write_text("[unplate.begin(result)]\n# one\n[unplate.end]\n")
+  stat = os.stat(file_loc)
+
+  coordinator = unplate.coordinator.Coordinator()
+  def compile():
+    return coordinator.compile(str(file_loc), unplate.options.Options(), lambda file_loc, options: open(file_loc).read())
+
+  assert '# one' in compile()
+
+  # an edit of the same size within one tick of a coarse clock
+  file_loc.write_text("[unplate.begin(result)]\n# two\n[unplate.end]\n")
+  os.utime(file_loc, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  assert '# two' in compile()
+
+
+def test__single_flight_processes(tmp_path):
+
+  file_loc = tmp_path / 'shared.py'
+  file_loc.write_text("[unplate.begin(result)]\n# shared\n[unplate.end]\n")
+  log_loc = tmp_path / 'compilations.log'
+
+  script = f"""if True:
+    import sys, time, unplate
+    compile_code = unplate.compile_code
+    def logging_compile_code(*args, **kwargs):
+      with open({str(log_loc)!r}, 'a') as log:
+        log.write('compiled\\n')
+      time.sleep(0.2)
+      return compile_code(*args, **kwargs)
+    unplate.compile_code = logging_compile_code
+    unplate.coordinator.coordinator.cache_dir = {str(tmp_path / 'cache')!r}
+
+    namespace = {{}}
+    exec(unplate.compile({str(file_loc)!r}), namespace)
+    print(namespace['result'], end='')
+  """
+
+  processes = [
+    subprocess.Popen(
+      [sys.executable, '-c', script], stdout=subprocess.PIPE, text=True,
+      cwd=os.path.dirname(os.path.dirname(unplate.__file__)),
+    )
+    for _ in range(4)
+  ]
+  outputs = [process.communicate()[0] for process in processes]
+
+  assert outputs == ['shared\n'] * 4
+  if unplate.coordinator.fcntl is not None:
+    assert log_loc.read_text() == 'compiled\n'
+
+
+@pytest.mark.skipif(not hasattr(os, 'getuid'), reason="no file owners")
+def test__cache_dir_permissions(tmp_path):
+
+  file_loc = tmp_path / 'page.py'
+  file_loc.write_text("[unplate.begin(result)]\n# page\n[unplate.end]\n")
+
+  def compile(cache_dir):
+    coordinator = unplate.coordinator.Coordinator(str(cache_dir))
+    return coordinator.compile(str(file_loc), unplate.options.Options(), lambda file_loc, options: 'compiled')
+
+  private = tmp_path / 'private'
+  assert compile(private) == 'compiled'
+  assert os.stat(private).st_mode & 0o077 == 0
+
+  shared = tmp_path / 'shared'
+  shared.mkdir()
+  os.chmod(shared, 0o777)
+  with pytest.raises(PermissionError):
+    compile(shared)
+
+
+def test__lazy():
+
+  options = unplate.options.Options()
+  options.lazy = True
+  options.lower_loops = True
+
+  code = """#newline
+def greet(name):
+  return unplate.template(
+    # Hello, {{ name }}!
+  )
+
+def partials():
+  [unplate.begin(row)]
+  # <td>{{ cell }}{{ suffix }}</td>
+  [unplate.end]
+
+def table(cells, suffix):
+  [unplate.begin(result)]
+  # <table>
+  # >>> for cell in cells:
+    # >>> include row
+  # <<<
+  # <p>{{ ', '.join(str(cell) + suffix for cell in cells) }}</p>
+  # </table>
+  [unplate.end]
+  return result
+
+def first(cells):
+  [unplate.begin(result)]
+  # >>> for cell in cells:
+    # >>> return cell
+  # <<<
+  [unplate.end]
+
+def fails():
+  return unplate.template(
+    # {{ undefined }}
+  )
+"""
+
+  python_code = unplate.compile_code(code, options, file_loc='lazy.py')
+  assert python_code.count('\n') == code.count('\n')
+  compact = python_code.replace(' ', '')
+  assert 'unplate.lazy.build(' in compact and 'unplate.lazy.render(' in compact
+  # a `>>> return` cannot be deferred
+  assert 'returncell' in compact
+
+  namespace = {'unplate': unplate}
+  exec(builtins.compile(python_code, 'lazy.py', 'exec'), namespace)
+
+  greet_region, row_region, table_region, fails_region = unplate.lazy.regions[-4:]
+  assert all(region.code is None for region in unplate.lazy.regions[-4:])
+
+  assert namespace['greet']('World') == 'Hello, World!\n'
+  assert greet_region.code is not None and table_region.code is None
+
+  assert namespace['table']([1, 2], '!') == '<table>\n<td>1!</td>\n<td>2!</td>\n<p>1!, 2!</p>\n</table>\n'
+  assert namespace['first']([3, 4]) == 3
+
+  # line numbers are those of the file
+  with pytest.raises(NameError) as info:
+    namespace['fails']()
+  assert info.traceback[-1].lineno + 1 == 32  # the line of {{ undefined }}
+
+  # recompiling does not register the templates again, even if they move
+  regions = len(unplate.lazy.regions)
+  unplate.compile_code(code, options, file_loc='lazy.py')
+  moved = code.replace('#newline\n', '#newline\n\n\n')
+  namespace = {'unplate': unplate}
+  exec(builtins.compile(unplate.compile_code(moved, options, file_loc='lazy.py'), 'lazy.py', 'exec'), namespace)
+  assert len(unplate.lazy.regions) == regions
+
+  # and line numbers follow them
+  with pytest.raises(NameError) as info:
+    namespace['fails']()
+  assert info.traceback[-1].lineno + 1 == 34
+
+
+def test__lazy_eager():
+
+  options = unplate.options.Options()
+  options.lazy = True
+
+  code = """#newline
+def first(cells):
+  [unplate.begin(result)]
+  # >>> for cell in cells:
+    # >>> if cell: return cell
+  # <<<
+  [unplate.end]
+
+def until_none(cells):
+  rows = []
+  for cell in cells:
+    [unplate.begin(row)]
+    # >>> for _ in range(1): pass
+    # >>> if cell is None: break
+    # <td>{{ cell }}</td>
+    [unplate.end]
+    rows.append(row)
+  return rows
+
+def count(cells):
+  [unplate.begin(result)]
+  # >>> for cell in cells:
+    # {{ cell }}
+    # >>> break
+  # <<<
+  [unplate.end]
+  return result
+"""
+
+  regions = len(unplate.lazy.regions)
+  namespace = {'unplate': unplate}
+  exec(unplate.compile_anon(code, options), namespace)
+  # only `count` breaks out of a loop of its own, so can be deferred
+  assert len(unplate.lazy.regions) == regions + 1
+
+  assert namespace['first']([0, 3, 4]) == 3
+  assert namespace['until_none'](['a', None, 'b']) == ['<td>a</td>\n']
+  assert namespace['count']([1, 2]) == '1\n'
+
+
+def test__lazy_identical_templates():
+
+  options = unplate.options.Options()
+  options.lazy = True
+  options.metrics = True
+
+  code = """#newline
+def a():
+  return unplate.template(
+    # {{ undefined }}
+  )
+
+def b():
+  return unplate.template(
+    # {{ undefined }}
+  )
+"""
+
+  unplate.metrics.registry.reset()
+  regions = len(unplate.lazy.regions)
+  namespace = {'unplate': unplate}
+  exec(builtins.compile(unplate.compile_code(code, options, file_loc='same.py'), 'same.py', 'exec'), namespace)
+  assert len(unplate.lazy.regions) == regions + 2
+
+  # each template keeps its own line numbers
+  for function, line in [('a', 4), ('b', 9), ('a', 4)]:
+    with pytest.raises(NameError) as info:
+      namespace[function]()
+    assert info.traceback[-1].lineno + 1 == line
+
+  # and still does when both move
+  moved = code.replace('#newline\n', '#newline\n\n')
+  exec(builtins.compile(unplate.compile_code(moved, options, file_loc='same.py'), 'same.py', 'exec'), namespace)
+  assert len(unplate.lazy.regions) == regions + 2
+  with pytest.raises(NameError) as info:
+    namespace['a']()
+  assert info.traceback[-1].lineno + 1 == 5
+
+  # labelled apart, by where the templates now start
+  namespace['undefined'] = 'x'
+  namespace['a'](), namespace['b']()
+  assert set(unplate.metrics.registry.as_dict()) == {'same.py:line 4', 'same.py:line 9'}
@@ -1,11 +1,28 @@
 import builtins
-import unplate.compile as unplate_compile
-import unplate.tokenize_util as tku
-import unplate.util
-import unplate.options
+import sys
+
+"""
+
+Submodules are imported lazily, on first use, so that `import unplate`
+stays cheap for short-lived processes. Tokenizing and compiling only
+happen once unplate.compile() is actually called.
+
+"""
+
+# Submodules loaded on attribute access, e.g. unplate.options
+lazy_submodules = ['compile', 'coordinator', 'lazy', 'metrics', 'options', 'reload', 'rope', 'tokenize_util', 'trace', 'util']
+
+
+def load(submodule):
+  """ Import and return the submodule unplate.<submodule> """
+  name = f'unplate.{submodule}'
+  __import__(name)
+  module = sys.modules[name]
+  # Importing unplate.compile sets the package attribute unplate.compile
+  # to the submodule, shadowing the function of the same name. Undo that.
+  globals()['compile'] = compile_file
+  return module
 
-# export UnplateSyntaxError
-UnplateSyntaxError = unplate_compile.UnplateSyntaxError
 
 def __getattr__(name):
   if name == 'template':
@@ -21,34 +38,108 @@ def __getattr__(name):
   if name == 'begin':
     raise AttributeError("unplate.begin should never be referenced during runtime.")
 
+  # export UnplateSyntaxError
+  if name == 'UnplateSyntaxError':
+    return load('compile').UnplateSyntaxError
+
+  if name in lazy_submodules:
+    return load(name)
+
+  raise AttributeError(f"module 'unplate' has no attribute {name!r}")
+
 
 true = True
 
 
-def compile(file_loc, options=options.defaults):
+def compile(file_loc, options=None):
+  """
+  Compile the Python + Unplate file at `file_loc` into a code object.
+
+  Concurrent and repeated compilations of the same file with the same
+  options are only done once; see unplate.coordinator.
+  """
+
+  if options is None:
+    options = load('options').defaults
+
+  return load('coordinator').coordinator.compile(file_loc, options, compile_now)
+
+compile_file = compile
+
+
+def compile_now(file_loc, options):
+  """ Compile a file, without coordinating with other compilations """
+
+  trace = load('trace')
+  event = trace.CompileEvent(file_loc) if trace.tracers else None
 
   with open(file_loc, 'r') as f:
     code = f.read()
 
-  python_code = compile_code(code, options, file_loc=file_loc)
+  if event is not None:
+    event.stage('read')
+
+  python_code = compile_code(code, options, file_loc=file_loc, event=event)
   # fucked up namespacing by calling this function unplate.compile
-  return builtins.compile(python_code, file_loc, 'exec')
+  compiled = builtins.compile(python_code, file_loc, 'exec')
+
+  if event is not None:
+    event.stage('builtins.compile')
+    trace.emit(event)
 
+  return compiled
 
-def compile_anon(code, options=options.defaults):
+
+def compile_anon(code, options=None):
   return compile_code(code, options, file_loc='<anonymous>')
 
 
-def compile_code(code, options=options.defaults, *, file_loc):
+def compile_code(code, options=None, *, file_loc, cache=None, event=None):
+  """
+  Compile Python + Unplate code into Python code.
+
+  If a trace event (see unplate.trace) is given, record into it rather
+  than emitting a new one; the caller emits it.
+  """
+
+  unplate_compile = load('compile')
+  tku = load('tokenize_util')
+  util = load('util')
+  trace = load('trace')
+
+  if options is None:
+    options = load('options').defaults
+
+  emit = event is None and bool(trace.tracers)
+  if emit:
+    event = trace.CompileEvent(file_loc)
 
   tokens = tku.tokenize_string(code)
-  compiled_tokens = unplate_compile.compile_top(tokens, options, file_loc=file_loc)
+
+  if event is not None:
+    event.stage('tokenize')
+    event.tokens = len(tokens)
+
+  compiled_tokens = unplate_compile.compile_top(tokens, options, file_loc=file_loc, cache=cache, event=event)
+
+  if event is not None:
+    event.stage('compile_top')
 
   # Remove the wrapper
   unplate_wrapper = tku.tokenize_expr('unplate.true')
   true_token = tku.tokenize_one('False')
   compiled_tokens = util.replace_sublist(compiled_tokens, unplate_wrapper, [true_token])
 
+  if event is not None:
+    event.stage('replace_sublist')
+
   compiled_code = tku.untokenize(compiled_tokens)
-  return compiled_code
 
+  if event is not None:
+    event.stage('untokenize')
+    event.code_size = len(compiled_code)
+
+  if emit:
+    trace.emit(event)
+
+  return compiled_code
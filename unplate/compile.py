@@ -1,6 +1,17 @@
+import ast
+import builtins
+import collections
+import copy
+import keyword
+import operator
+import re
+import string
+import time
 import tokenize as tk
 import itertools as it
+import unplate
 import unplate.tokenize_util as tku
+import unplate.trace as trace
 import unplate.util as util
 from unplate.options import Options
 
@@ -42,14 +53,16 @@ class UnplateSyntaxError(SyntaxError):
     )
 
 
-def compile_top(tokens, options: Options, *, file_loc):
+def compile_top(tokens, options: Options, *, file_loc, cache=None, event=None):
   """
   Top-level compilation function.
   Transform Python + Unplate source tokens into native Python source tokens.
   """
 
+  options.validate()
+
   try:
-    compiled, rest = compile_tokens(tokens, options)
+    compiled, rest = compile_tokens(tokens, options, file_loc=file_loc, cache=cache, event=event)
   except UnplateSyntaxError as err:
     err.file_loc = file_loc
     raise err
@@ -154,61 +167,57 @@ def read_template_body(tokens, indents, options):
     return lines, rest_tokens
 
 
-def repr_with_newlines(string):
+def repr_with_newlines(value):
   """
-  return the string, passed through repr(), but with
+  return the value, passed through repr(), but with
   newlines intact.
 
   Thus the string "new\nline" becomes not "new\\nline" but instead
   a string with a literal newline in it: '''new
 line'''
+
+  Works for both str and bytes.
   """
 
   # single-line string
-  if '\n' not in string:
-    return repr(string)
+  if ('\n' if isinstance(value, str) else b'\n') not in value:
+    return repr(value)
 
   # multiline string
   else:
-    reprd = repr(string)
+    reprd = repr(value)
+
+    # 'b' for bytes, nothing for str
+    prefix = 'b' if isinstance(value, bytes) else ''
+    reprd = reprd[len(prefix):]
 
     # either ' or ", depending on how repr() decides to handle escapes
     quote_type = reprd[0]
 
     newlines_returned = reprd.replace('\\n', '\n')
-    multiline_quotes = quote_type * 2 + newlines_returned + quote_type * 2
+    multiline_quotes = prefix + quote_type * 2 + newlines_returned + quote_type * 2
     return multiline_quotes
 
 
-def compile_content(string, options):
+def split_content(string, options, *, fold=True):
   """
   Given a string which is the literal content of a template,
-  return the Python code for the runtime interpretation of that string.
+  split it into chunks, returning a list of pairs (is_expr, text).
   For instance, given
 
     "<h1>{{ title }}</h1>"
 
-  returns (something like)
-
-    "<h1>" + str(title) + "</h1>"
-
-  If the given string contains newlines, these will be preserved in the
-  returned code. Thus
-
-    '''first line {{ interpolated }}
-    second line'''
+  returns
 
-  is mapped to (something like)
+    [(False, "<h1>"), (True, " title "), (False, "</h1>")]
 
-    "'first line' + str(interpolated) + '''
-    second line'''"
+  Empty static chunks are omitted.
 
+  If options.fold_constants is set and `fold` is true, interpolations of
+  constant expressions are rendered here and become part of the static text.
   """
 
-  # resultant `exprs` will be a sequence of python expressions which
-  # are to be concatenated in the end
-  # For example, exprs may be ['"<h1>"', 'str(title)', '"</h1>"']
-  exprs = []
+  chunks = []
 
   # are we in a string or in an interpolated expression?
   in_expr = False
@@ -220,22 +229,11 @@ def compile_content(string, options):
 
   def end_chunk():
     chunk = string[chunk_start:i]
+    if in_expr or chunk:
+      chunks.append((in_expr, chunk))
 
-    if in_expr:
-      code = f"str({chunk})"
-    else:
-      code = repr_with_newlines(chunk)
-
-    exprs.append(code)
-
-  i = -1
-  while True:
-    i += 1
-    if i >= len(string):
-      break
-
-    char = string[i]
-    next_char = string[i + 1] if i + 1 < len(string) else None
+  i = 0
+  while i < len(string):
 
     if util.starts_with(string, options.interpolation_open, start=i):
       end_chunk()
@@ -255,15 +253,479 @@ def compile_content(string, options):
 
       in_expr = False
 
+    else:
+      i += 1
+
   end_chunk()
 
-  # now we have a bunch of expressions
-  # at runtime, they'll need to be joined together
-  # we'll do that with ''.join()
+  if fold and options.fold_constants:
+    chunks = fold_chunks(chunks, options)
+
+  return chunks
+
+
+class NotConstant(Exception):
+  """ Raised by evaluate_constant() for expressions that cannot be folded """
+
+
+# The most characters a folded interpolation may produce. Past this, leave it to runtime.
+MAX_FOLDED_SIZE = 4096
+
+# Methods of str which may be called during constant folding
+FOLDABLE_STR_METHODS = {
+  'capitalize', 'casefold', 'center', 'format', 'join', 'ljust', 'lower', 'lstrip',
+  'replace', 'rjust', 'rstrip', 'strip', 'swapcase', 'title', 'upper', 'zfill',
+}
+
+BINARY_OPERATORS = {
+  ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+  ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+  ast.Pow: operator.pow, ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+  ast.BitOr: operator.or_, ast.BitXor: operator.xor, ast.BitAnd: operator.and_,
+}
+
+UNARY_OPERATORS = {
+  ast.UAdd: operator.pos, ast.USub: operator.neg, ast.Not: operator.not_, ast.Invert: operator.invert,
+}
+
+COMPARISON_OPERATORS = {
+  ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+  ast.Gt: operator.gt, ast.GtE: operator.ge, ast.In: lambda a, b: a in b,
+  ast.NotIn: lambda a, b: a not in b, ast.Is: operator.is_, ast.IsNot: operator.is_not,
+}
+
+
+def check_size(value):
+  """ Raise NotConstant if a value is too big to be worth folding """
+  if isinstance(value, (str, bytes, tuple)) and len(value) > MAX_FOLDED_SIZE:
+    raise NotConstant
+  if isinstance(value, int) and value.bit_length() > MAX_FOLDED_SIZE:
+    raise NotConstant
+  return value
+
+
+def check_spec(spec):
+  """
+  Raise NotConstant if a format spec could produce a huge value, like the
+  width in '{:>1000000000}', or has widths filled in from elsewhere.
+  Checked before formatting, as formatting would build the value.
+  """
+  if '{' in spec or '*' in spec or any(int(number) > MAX_FOLDED_SIZE for number in re.findall(r'\d+', spec)):
+    raise NotConstant
+
+
+# The conversion specifiers in a %-format string, e.g. '%-10s'
+PERCENT_SPEC = re.compile(r'%(?:\([^)]*\))?[^a-zA-Z%]*[a-zA-Z%]')
+
+
+def evaluate_constant(node, constants):
+  """
+  Evaluate an expression AST made only of literals, names in `constants`,
+  operators, and a few pure str methods, e.g. `'-' * WIDTH`.
+  Raise NotConstant for anything else.
+
+  Operations which could produce huge values (like `10 ** 10 ** 10`) are
+  refused before they are performed, since the template may never render.
+  """
+
+  def evaluate(node):
+    return evaluate_constant(node, constants)
+
+  if isinstance(node, ast.Constant):
+    return node.value
+
+  if isinstance(node, ast.Name) and node.id in constants:
+    return constants[node.id]
+
+  if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+    return UNARY_OPERATORS[type(node.op)](evaluate(node.operand))
+
+  if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+    left, right = evaluate(node.left), evaluate(node.right)
+
+    # refuse to compute anything big
+    if isinstance(node.op, ast.Mult):
+      for seq, count in [(left, right), (right, left)]:
+        if isinstance(seq, (str, bytes, tuple)) and isinstance(count, int) and len(seq) * count > MAX_FOLDED_SIZE:
+          raise NotConstant
+    if isinstance(node.op, (ast.Pow, ast.LShift)) and isinstance(right, int):
+      if isinstance(left, int) and left.bit_length() * abs(right) > MAX_FOLDED_SIZE:
+        raise NotConstant
+    # e.g. '%1000000000s' % 'x'
+    if isinstance(node.op, ast.Mod) and isinstance(left, (str, bytes)):
+      specs = PERCENT_SPEC.findall(left if isinstance(left, str) else left.decode('latin-1'))
+      for spec in specs:
+        check_spec(spec)
+
+    return check_size(BINARY_OPERATORS[type(node.op)](left, right))
+
+  if isinstance(node, ast.BoolOp):
+    value = evaluate(node.values[0])
+    for operand in node.values[1:]:
+      if bool(value) == isinstance(node.op, ast.Or):
+        break
+      value = evaluate(operand)
+    return value
+
+  if isinstance(node, ast.Compare):
+    left = evaluate(node.left)
+    for op, comparator in zip(node.ops, node.comparators):
+      right = evaluate(comparator)
+      if not COMPARISON_OPERATORS[type(op)](left, right):
+        return False
+      left = right
+    return True
+
+  if isinstance(node, ast.IfExp):
+    return evaluate(node.body) if evaluate(node.test) else evaluate(node.orelse)
+
+  if isinstance(node, ast.Tuple):
+    return tuple(evaluate(elt) for elt in node.elts)
+
+  if isinstance(node, ast.Subscript):
+    return check_size(evaluate(node.value)[evaluate(node.slice)])
+
+  if isinstance(node, ast.Slice):
+    return slice(*(part and evaluate(part) for part in [node.lower, node.upper, node.step]))
+
+  if isinstance(node, ast.JoinedStr):
+    return check_size(''.join(str(evaluate(value)) for value in node.values))
+
+  if isinstance(node, ast.FormattedValue):
+    value = evaluate(node.value)
+    conversion = {-1: None, ord('s'): str, ord('r'): repr, ord('a'): ascii}[node.conversion]
+    if conversion is not None:
+      value = conversion(value)
+    spec = evaluate(node.format_spec) if node.format_spec else ''
+    check_spec(spec)
+    return check_size(format(value, spec))
+
+  if (isinstance(node, ast.Call)
+      and isinstance(node.func, ast.Attribute)
+      and node.func.attr in FOLDABLE_STR_METHODS):
+    receiver = evaluate(node.func.value)
+    if not isinstance(receiver, str):
+      raise NotConstant
+    args = [evaluate(arg) for arg in node.args]
+    kwargs = {keyword.arg: evaluate(keyword.value) for keyword in node.keywords if keyword.arg is not None}
+    if len(kwargs) != len(node.keywords):
+      raise NotConstant
+    # e.g. 'x'.ljust(10 ** 9)
+    if any(isinstance(arg, int) and arg > MAX_FOLDED_SIZE for arg in [*args, *kwargs.values()]):
+      raise NotConstant
+    # e.g. '{:>1000000000}'.format('x')
+    if node.func.attr == 'format':
+      for _, _, spec, _ in string.Formatter().parse(receiver):
+        check_spec(spec or '')
+    # e.g. ('x' * 4096).replace('x', 'y' * 4096)
+    if node.func.attr == 'replace' and len(args) >= 2 and isinstance(args[0], str) and isinstance(args[1], str):
+      count = receiver.count(args[0]) if args[0] else len(receiver) + 1
+      if count * len(args[1]) > MAX_FOLDED_SIZE:
+        raise NotConstant
+    return check_size(getattr(receiver, node.func.attr)(*args, **kwargs))
+
+  raise NotConstant
+
+
+def fold_chunks(chunks, options):
+  """
+  Replace interpolated chunks whose values are known at compile time
+  (see evaluate_constant) with static chunks of their rendered text.
+  """
+
+  folded = []
+
+  for is_expr, chunk in chunks:
+
+    if is_expr:
+      try:
+        tree = ast.parse(chunk.strip(), mode='eval')
+        value = evaluate_constant(tree.body, options.constants)
+        # as at runtime, bytes are interpolated as they are; static chunks are encoded later
+        if options.output_bytes and type(value) is bytes:
+          text = value.decode(options.encoding)
+        else:
+          text = str(value)
+        if len(text) > MAX_FOLDED_SIZE:
+          raise NotConstant
+      # Anything not constant is left for runtime. So are errors, e.g. {{ 1 / 0 }}:
+      # they should only be raised if the template is actually rendered
+      except Exception:
+        pass
+      else:
+        is_expr, chunk = False, text
+
+    folded.append((is_expr, chunk))
+
+  return merge_chunks(folded)
+
+
+def merge_chunks(chunks):
+  """ Merge adjacent static chunks, as returned by split_content() """
+
+  merged = []
+  for is_expr, chunk in chunks:
+    if merged and not is_expr and not merged[-1][0]:
+      merged[-1] = (False, merged[-1][1] + chunk)
+    else:
+      merged.append((is_expr, chunk))
+
+  return merged
+
+
+class Minifier:
+  """
+  Removes insignificant whitespace from the static text of HTML/XML
+  template lines, for options.minify.
+
+  In static text, runs of whitespace are collapsed to a single space,
+  leading and trailing whitespace on each line is removed, and blank
+  lines are dropped. Interpolated code, quoted attribute values, and the
+  contents of <pre>, <textarea>, <script> and <style> elements, are left
+  untouched.
+
+  Keeps track of whether it is inside a tag, an attribute value or one of
+  those elements from one line to the next, so a single Minifier should
+  see all the lines of a template.
+  """
+
+  raw_element = re.compile(r'<(/?)(pre|textarea|script|style)\b[^>]*>', re.IGNORECASE)
+  # HTML's ASCII whitespace only: e.g. a no-break space is significant
+  ascii_whitespace = ' \t\n\r\f'
+  whitespace = re.compile(f'[{ascii_whitespace}]+')
+  # the pieces of text collapse() needs to look at
+  pieces = re.compile(f'[<>"\']|[{ascii_whitespace}]+|[^<>"\'{ascii_whitespace}]+')
+
+  def __init__(self, options):
+    self.options = options
+    # name of the raw element we are inside, if any
+    self.raw = None
+    # whether we are inside a tag, and the quote of the attribute value we are inside, if any
+    self.tag = False
+    self.quote = None
+
+  def static(self, text):
+    """ Minify a chunk of static text """
+
+    minified = []
+    start = 0
+
+    for match in self.raw_element.finditer(text):
+      minified.append(self.collapse(text[start:match.start()]))
+      start = match.start()
+      # e.g. title="<pre>" is not an element
+      if self.tag:
+        continue
+      minified.append(match.group(0))
+      start = match.end()
+
+      is_close, name = match.group(1) == '/', match.group(2).lower()
+      if self.raw is None and not is_close:
+        self.raw = name
+      elif is_close and name == self.raw:
+        self.raw = None
+
+    minified.append(self.collapse(text[start:]))
+    return ''.join(minified)
+
+  def collapse(self, text):
+    if self.raw is not None:
+      return text
+
+    collapsed = []
+    for piece in self.pieces.findall(text):
+      if self.quote is not None:
+        if piece == self.quote:
+          self.quote = None
+      elif piece[0] in self.ascii_whitespace:
+        piece = ' '
+      elif piece == '<':
+        self.tag = True
+      elif piece == '>':
+        self.tag = False
+      elif self.tag and piece in '"\'':
+        self.quote = piece
+      collapsed.append(piece)
+
+    return ''.join(collapsed)
+
+  def line(self, line):
+    """
+    Minify a line of a template, without its trailing newline.
+    Return None if the line should be dropped.
+    """
+
+    # whitespace at the edges of raw elements and attribute values is kept
+    raw_at_start = self.raw is not None or self.quote is not None
+    chunks = [
+      (is_expr, chunk if is_expr else self.static(chunk))
+      for is_expr, chunk in split_content(line, self.options, fold=False)
+    ]
+    raw_at_end = self.raw is not None or self.quote is not None
+
+    if chunks and not chunks[0][0] and not raw_at_start:
+      chunks[0] = (False, chunks[0][1].lstrip(self.ascii_whitespace))
+    if chunks and not chunks[-1][0] and not raw_at_end:
+      chunks[-1] = (False, chunks[-1][1].rstrip(self.ascii_whitespace))
+
+    if not raw_at_start and not any(is_expr or chunk for is_expr, chunk in chunks):
+      return None
+
+    open, close = self.options.interpolation_open, self.options.interpolation_close
+    return ''.join(open + chunk + close if is_expr else chunk for is_expr, chunk in chunks)
+
+
+def compile_chunks(chunks, options, *, keep_newlines=True, ropes=False, segments=None, spliced=()):
+  """
+  Given chunks as returned by split_content(), return a list of Python
+  expressions, one per chunk, which evaluate to the rendered chunks.
+  For instance, given
+
+    [(False, "<h1>"), (True, " title "), (False, "</h1>")]
+
+  returns (something like)
+
+    ["'<h1>'", "str( title )", "'</h1>'"]
+
+  If options.output_bytes is set, static chunks are encoded here, at
+  compile time, and only interpolated values are encoded at runtime.
+  Interpolated values which are already bytes are left as they are.
+
+  If keep_newlines is true, newlines in static chunks will be preserved
+  in the returned code (see repr_with_newlines).
+
+  If ropes is true, interpolated values which are Ropes are also left as
+  they are, rather than converted with str().
+
+  These type checks are inlined, so need each value bound to a name. If
+  segments is a list, interpolations other than plain names are evaluated
+  into temporaries first -- and then, to keep the order of evaluation, so
+  are plain names: (temporary, expression) pairs are appended to
+  `segments`, and the caller must bind them before the returned
+  expressions run. Otherwise, they are bound by calling a lambda.
+
+  Interpolations of just a name in `spliced`, the result of a nested
+  template builder, are not converted at all: the result is already
+  rendered, as str, bytes, a list of chunks or a Rope. Lists of chunks
+  are unpacked with *, so the expressions must go in a list or tuple.
+  """
+
+  def is_name(code):
+    return code.isidentifier() and not keyword.iskeyword(code)
+
+  checked = ['unplate.rope.Rope'] * ropes + ['bytes'] * options.output_bytes
+
+  def convert(value):
+    converted = f"str({value})"
+    if options.output_bytes:
+      converted += f".encode({options.encoding!r})"
+    if not checked:
+      return converted
+    check = ' or '.join(f"type({value}) is {type_name}" for type_name in checked)
+    return f"({value} if {check} else {converted})"
+
+  bind_all = checked and segments is not None and any(
+    is_expr and chunk.strip() not in spliced and not is_name(chunk.strip()) for is_expr, chunk in chunks
+  )
+
+  exprs = []
+
+  for is_expr, chunk in chunks:
+
+    if is_expr and chunk.strip() in spliced:
+      code = chunk.strip()
+      if options.builder_output == 'chunks':
+        code = '*' + code
+
+    elif is_expr and bind_all:
+      value = f"unplate_segment_{len(segments)}"
+      segments.append((value, chunk))
+      code = convert(value)
+
+    elif is_expr and checked and not is_name(chunk.strip()):
+      code = f"(lambda unplate_segment: {convert('unplate_segment')})({chunk})"
+
+    elif is_expr and checked:
+      code = convert(chunk.strip())
+
+    elif is_expr:
+      code = convert(chunk)
+
+    else:
+      value = chunk.encode(options.encoding) if options.output_bytes else chunk
+      code = repr_with_newlines(value) if keep_newlines else repr(value)
+
+    exprs.append(code)
+
+  return exprs
+
+
+def join_chunks(chunks, options, *, keep_newlines=True, segments=None, spliced=()):
+  """
+  Given chunks as returned by split_content(), return the Python code
+  for their runtime concatenation. See compile_chunks for `segments`.
+  """
+
+  empty = "b''" if options.output_bytes else "''"
+  exprs = compile_chunks(chunks, options, keep_newlines=keep_newlines, segments=segments, spliced=spliced)
+
+  if not exprs:
+    return empty
+
+  # no need to join a single static chunk
+  if len(chunks) == 1 and not chunks[0][0]:
+    return exprs[0]
+
   list_expr = '[' + ', '.join(exprs) + ']'
-  code = f"''.join({list_expr})"
+  return f"{empty}.join({list_expr})"
+
+
+def format_chunks(chunks, options, spliced=(), segments=None):
+  """
+  Like join_chunks, but for str output uses %-formatting, e.g.
+
+    '<h1>%s</h1>' % ((title),)
+
+  which is quicker than joining a list when there are interpolations.
+  '%s' calls str() just like join_chunks does.
+  """
+
+  exprs = [chunk for is_expr, chunk in chunks if is_expr]
+  if options.output_bytes or not exprs:
+    return join_chunks(chunks, options, keep_newlines=False, segments=segments, spliced=spliced)
+
+  format_string = ''.join('%s' if is_expr else chunk.replace('%', '%%') for is_expr, chunk in chunks)
+  args = ''.join(f"({expr}), " for expr in exprs)
+  return f"{format_string!r} % ({args})"
 
-  return code
+
+def compile_content(string, options):
+  """
+  Given a string which is the literal content of a template,
+  return the Python code for the runtime interpretation of that string.
+  For instance, given
+
+    "<h1>{{ title }}</h1>"
+
+  returns (something like)
+
+    "<h1>" + str(title) + "</h1>"
+
+  If the given string contains newlines, these will be preserved in the
+  returned code. Thus
+
+    '''first line {{ interpolated }}
+    second line'''
+
+  is mapped to (something like)
+
+    "'first line' + str(interpolated) + '''
+    second line'''"
+
+  """
+
+  chunks = split_content(string, options)
+  return join_chunks(chunks, options)
 
 
 def consume_prefix(tokens, literal):
@@ -274,22 +736,428 @@ def consume_prefix(tokens, literal):
   return tokens[len(literal):]
 
 
-def compile_template_literal(tokens, indents, options):
+def compile_template_literal(tokens, indents, options, state):
+  if options.metrics:
+    label = metrics_label(compile_template_literal, tokens, options, state)
+
   tokens = consume_prefix(tokens, options.template_literal_open)
   lines, tokens = read_template_body(tokens, indents, options)
   tokens = consume_prefix(tokens, options.template_literal_close)
 
+  dropped = 0
+  if options.minify:
+    minifier = Minifier(options)
+    minified = [minifier.line(line) for line in lines]
+    lines = [line for line in minified if line is not None]
+    dropped = len(minified) - len(lines)
+
   content = ''.join(line + '\n' for line in lines)
   compiled = tku.tokenize_expr(compile_content(content, options))
 
+  if options.metrics:
+    pattern = tku.tokenize_expr(f"unplate.metrics.observe({label!r}, unplate.metrics.clock(), VALUE)")
+    prefix, suffix = tku.split_pattern(pattern, 'VALUE')
+    compiled = prefix + compiled + suffix
+
   # Pad compiled code to preserve line numbers
   pad = tku.tokenize_expr('(\n)')
-  compiled = pad[:2] + compiled + pad[2:]
+  compiled = pad[:2] + compiled + [tku.dtok.new(tk.NL, '\n')] * dropped + pad[2:]
 
   return compiled, tokens
 
 
-def compile_template_builder(tokens, indents, options):
+def simple_loop_body(python_code, pending, keyword='for'):
+  """
+  Given the Python code of a `>>>` line in a template builder, and the stack
+  of lines after it, check whether the code opens a for-loop (or another
+  block, given its keyword) whose body is only template lines -- no `>>>`
+  statements, no nested blocks. If so, return the lines of the body.
+  Otherwise, return None.
+  """
+
+  if not (python_code.startswith(keyword + ' ') and python_code.rstrip().endswith(':')):
+    return None
+
+  body = []
+  for i in range(len(pending) - 1, -1, -1):
+    stripped = pending[i].strip()
+
+    if stripped == '<<<':
+      # for/else and if/elif/else cannot be lowered
+      if i > 0 and pending[i - 1].strip().startswith(('>>> else', '>>> elif')):
+        return None
+      return body or None
+
+    if stripped.startswith(('>>>', '<<<')):
+      return None
+
+    body.append(pending[i])
+
+  return None
+
+
+def compile_lowered_loop(template_name, python_code, body, options, minifier=None, spliced=()):
+  """
+  Compile a simple for-loop (see simple_loop_body) in a template builder
+  into a single call of the form
+
+    template_name.extend([<line value> for row in rows])
+
+  instead of a Python loop with an append per line per iteration.
+  Returns None if the loop header cannot be used in a list comprehension.
+
+  The resulting statement is followed by blank lines to make up for the
+  body and the closing '<<<', preserving line numbers.
+  """
+
+  loop = python_code.rstrip()[:-1]
+
+  # Headers such as `for x in a, b:` are fine in a for statement but
+  # not in a list comprehension
+  try:
+    builtins.compile(f"[None {loop}]", '<unplate>', 'eval')
+  except SyntaxError:
+    return None
+
+  chunks = body_chunks(body, options, minifier)
+
+  segments = []
+  if options.builder_output in ['chunks', 'rope']:
+    exprs = compile_chunks(chunks, options, keep_newlines=False,
+      ropes=options.builder_output == 'rope', segments=segments, spliced=spliced)
+    bindings = ''.join(f" for {name} in ({expr},)" for name, expr in segments)
+    value = f"unplate_chunk {loop}{bindings} for unplate_chunk in ({', '.join(exprs)},)"
+  else:
+    formatted = format_chunks(chunks, options, spliced, segments)
+    bindings = ''.join(f" for {name} in ({expr},)" for name, expr in segments)
+    value = f"{formatted} {loop}{bindings}"
+
+  code = f"{template_name}.extend([{value}])\n"
+
+  blank_lines = [tku.dtok.new(tk.NL, '\n')] * (len(body) + 1)
+  return tku.tokenize_stmt(code) + blank_lines
+
+
+def compile_lowered_if(template_name, python_code, body, options, minifier=None, spliced=()):
+  """
+  Like compile_lowered_loop, but for an if-block with only template lines,
+  which is compiled into a single expression statement
+
+    template_name.extend([<line value>]) if condition else None
+
+  Returns None if the condition is not an expression.
+  """
+
+  condition = python_code.rstrip()[len('if '):-1]
+
+  try:
+    builtins.compile(f"({condition})", '<unplate>', 'eval')
+  except SyntaxError:
+    return None
+
+  chunks = body_chunks(body, options, minifier)
+
+  # evaluated only if the condition holds, so not bound to temporaries beforehand
+  if options.builder_output in ['chunks', 'rope']:
+    exprs = compile_chunks(chunks, options, keep_newlines=False, ropes=options.builder_output == 'rope', spliced=spliced)
+    code = f"{template_name}.extend([{', '.join(exprs)}]) if ({condition}) else None\n"
+  else:
+    code = f"{template_name}.append({format_chunks(chunks, options, spliced)}) if ({condition}) else None\n"
+
+  blank_lines = [tku.dtok.new(tk.NL, '\n')] * (len(body) + 1)
+  return tku.tokenize_stmt(code) + blank_lines
+
+
+def body_chunks(body, options, minifier=None):
+  """ The chunks of the template lines of a lowered block, merged """
+
+  chunks = []
+  for line in body:
+    if minifier is not None:
+      line = minifier.line(line)
+      if line is None:
+        continue
+    chunks.extend(split_content(line + '\n', options))
+  return merge_chunks(chunks)
+
+
+class CompileState:
+  """
+  What the compilation of one file knows beyond the template at hand.
+
+    file_loc        the file being compiled
+    partials        the template builders compiled so far in the file, by
+                    name, so that later ones can `>>> include` them. Maps
+                    names to lines, with includes expanded
+    used_partials   the partials looked up since the last reset, and what
+                    they were at the time
+    unused_after    names which the compiled code assumes are not used
+                    anywhere else in the file (see plan_fusion)
+    occurrences     how many times each lazy template has been seen so
+                    far, by content (see compile_lazy)
+
+  used_partials and unused_after let cached compilations
+  (see unplate.reload.RegionCache) check that they are still valid.
+
+  `source_tokens` are all the tokens of the file, for mentions().
+  """
+
+  def __init__(self, file_loc=None, source_tokens=()):
+    self.file_loc = file_loc
+    self.partials = {}
+    self.used_partials = {}
+    self.unused_after = set()
+    self.source_tokens = list(source_tokens)
+    self.words = None
+    self.occurrences = collections.Counter()
+
+  def word_counts(self):
+    """ Count the words of the file: in code, in comments and in strings, and so in templates """
+    if self.words is None:
+      self.words = collections.Counter(
+        word for tok in self.source_tokens for word in re.findall(r'\w+', tok.string)
+      )
+    return self.words
+
+  def mentions(self, name):
+    """ How many times `name` occurs as a word anywhere in the file """
+    return self.word_counts()[name]
+
+  def include(self, name):
+    """ Return the lines of a partial, or None if there is no such partial """
+    lines = self.partials.get(name)
+    self.used_partials[name] = lines
+    return lines
+
+  def define(self, name, lines):
+    self.partials[name] = lines
+
+
+def parse_include(line):
+  """
+  If a template builder line is an include, like `>>> include name`,
+  return the included name. Otherwise, return None.
+  """
+
+  words = line.split()
+  if len(words) == 3 and words[:2] == ['>>>', 'include'] and words[2].isidentifier():
+    return words[2]
+  return None
+
+
+class IncludeEnd(str):
+  """
+  Marks where the lines of an included template builder end, in the stack
+  of lines still to compile. Behaves as a blank line to anything looking
+  ahead through the stack.
+
+    name    the included template builder
+    start   where its compiled code starts
+  """
+
+  def __new__(cls, name, start):
+    self = super().__new__(cls, '')
+    self.name = name
+    self.start = start
+    return self
+
+
+# first tokens of compound statements
+compound_keywords = {'if', 'elif', 'else', 'for', 'while', 'with', 'try', 'except', 'finally', 'def', 'class', 'async', '@'}
+
+
+def single_line(compiled):
+  """
+  Given the compiled code of an included template builder, put it all on
+  one line, so that line numbers after the include still match the file:
+  simple statements are joined with ';'. A compound statement may only
+  come first, with a body of simple statements, as in
+
+    for x in xs: a; b
+
+  Returns the tokens of the line, or None if the code cannot be put on one.
+  """
+
+  statements = []  # (depth, tokens)
+  depth = 0
+  current = []
+  for tok in compiled:
+    if tok.type in [tk.NEWLINE, tk.NL, tk.INDENT, tk.DEDENT]:
+      if current:
+        statements.append((depth, current))
+        current = []
+      depth += {tk.INDENT: 1, tk.DEDENT: -1}.get(tok.type, 0)
+    else:
+      current.append(tok)
+  if current:
+    statements.append((depth, current))
+
+  if not statements:
+    return tku.tokenize_stmt('pass\n')
+
+  def is_compound(tokens):
+    return tokens[0].string in compound_keywords
+
+  header, *body = statements
+  if body and body[0][0] == 1:
+    if header[0] != 0 or not is_compound(header[1]) or header[1][-1].string != ':':
+      return None
+    rest = body
+    line = header[1]
+  else:
+    rest = statements
+    line = []
+    if len(statements) > 1 and any(is_compound(tokens) for _, tokens in statements):
+      return None
+
+  expected_depth = rest[0][0] if rest else 0
+  for index, (depth, tokens) in enumerate(rest):
+    if depth != expected_depth or (line and is_compound(tokens)):
+      return None
+    if index:
+      line = line + [tku.dtok.new(tk.OP, ';')]
+    line = line + tokens
+
+  return line + [tku.dtok.new(tk.NEWLINE, '\n')]
+
+
+def closing_statement(template_name, options):
+  """
+  The code run when a template builder closes, turning the list it has
+  built into its result. None if the list is the result.
+  """
+
+  if options.builder_output == 'joined':
+    empty = "b''" if options.output_bytes else "''"
+    return f"{template_name} = {empty}.join({template_name})"
+
+  if options.builder_output == 'rope':
+    return f"{template_name} = unplate.rope.Rope({template_name})"
+
+  return None
+
+
+def tokenize_line(python_code):
+  """ Tokenize the code of a `>>>` line, without trailing newlines """
+  return [tok for tok in tku.tokenize_stmt(python_code) if tok.type not in [tk.NEWLINE, tk.NL]]
+
+
+def parse_nested_begin(python_code, options):
+  """
+  If the code of a `>>>` line opens a nested template builder, like
+  `[unplate.begin(name)]`, return the name. Otherwise, return None.
+  """
+
+  left, right = options.template_builder_open_left, options.template_builder_open_right
+  toks = tokenize_line(python_code)
+
+  if (len(toks) == len(left) + 1 + len(right)
+      and util.prefix_is(toks, left)
+      and toks[len(left)].type == tk.NAME
+      and toks[len(left) + 1:] == right):
+    return toks[len(left)].string
+
+  return None
+
+
+def is_nested_end(python_code, options):
+  """ Does the code of a `>>> ` line close a nested template builder? """
+  return tokenize_line(python_code) == options.template_builder_close
+
+
+# `>>>` code which may leave a nested template builder part-way through
+control_flow = re.compile(r'\b(continue|break|return|raise|yield)\b')
+# `>>>` code which may carry on after an exception part-way through a nested template builder
+exception_handling = re.compile(r'^(try|with|async\s+with)\b')
+
+
+def plan_fusion(name, pending, expanded, state, options):
+  """
+  Check whether the nested template builder `name`, just opened, can
+  write straight into its parent rather than into a list of its own.
+  The top of `pending` is the nested builder's body.
+
+  This is the case when the result is used only once, in the parent
+  line right after the nested builder closes, and nothing but static
+  text comes before it on that line:
+
+    >>> [unplate.begin(cells)]
+    ...
+    >>> [unplate.end]
+    <tr>{{ cells }}</tr>
+
+  The nested builder must also always run to its end, since the prefix is
+  written before it runs: its body may not contain control flow like
+  `>>> continue`, and the template may not handle exceptions.
+
+  Returns a tuple (index, prefix, suffix_line) where `index` is the
+  position of that line in `pending`, `prefix` is the static text before
+  the interpolation, and `suffix_line` is what is left of the line
+  after it. Otherwise, returns None.
+  """
+
+  # find the matching [unplate.end]
+  depth = 0
+  end_index = None
+  for i in range(len(pending) - 1, -1, -1):
+    stripped = pending[i].strip()
+    if not stripped.startswith('>>> '):
+      continue
+    python_code = stripped[len('>>> '):]
+    if parse_nested_begin(python_code, options) is not None:
+      depth += 1
+    elif is_nested_end(python_code, options):
+      if depth == 0:
+        end_index = i
+        break
+      depth -= 1
+
+  if end_index is None or end_index == 0:
+    return None
+
+  index = end_index - 1
+  line = pending[index]
+  if line.strip().startswith(('>>>', '<<<')):
+    return None
+
+  chunks = split_content(line, options, fold=False)
+  exprs = [i for i, (is_expr, chunk) in enumerate(chunks) if is_expr]
+  if len(exprs) != 1 or chunks[exprs[0]][1].strip() != name:
+    return None
+
+  def with_includes(lines):
+    for line in lines:
+      included_name = parse_include(line)
+      yield from [line] if included_name is None else state.partials.get(included_name) or []
+
+  def statements(lines):
+    return [line.strip()[len('>>> '):] for line in lines if line.strip().startswith('>>> ')]
+
+  lines = list(with_includes(expanded + pending))
+  body = list(with_includes(pending[end_index + 1:]))
+  if any(control_flow.search(python_code) for python_code in statements(body)):
+    return None
+  if any(exception_handling.match(python_code) for python_code in statements(lines)):
+    return None
+
+  # the name must not be used anywhere else: not in this template
+  # (besides where it is opened and interpolated), not in anything it
+  # includes, and nowhere else in the file
+  mentions = re.compile(rf'\b{re.escape(name)}\b')
+  if sum(len(mentions.findall(line)) for line in lines) != 2:
+    return None
+  if state.mentions(name) != 2:
+    return None
+  state.unused_after.add(name)
+
+  k = exprs[0]
+  prefix = ''.join(chunk for is_expr, chunk in chunks[:k])
+  open, close = options.interpolation_open, options.interpolation_close
+  suffix_line = ''.join(open + chunk + close if is_expr else chunk for is_expr, chunk in chunks[k + 1:])
+  return index, prefix, suffix_line
+
+
+def compile_template_builder(tokens, indents, options, state):
   """
   Consume and compile a template builder construct ala
 
@@ -302,13 +1170,26 @@ def compile_template_builder(tokens, indents, options):
     # <<<
     [unplate.end]
 
-  Requires the indent stack.
+  A line `>>> include other_template` inlines the body of the template
+  builder `other_template`, which must be defined earlier in the file, at
+  compile time. The included lines write directly into this template and
+  see the same variables.
+
+  Template builders may be nested with `>>> [unplate.begin(inner)]` and
+  `>>> [unplate.end]`. If the result of a nested template builder is only
+  interpolated into its parent (see plan_fusion), the nested builder is
+  compiled to write directly into the parent instead of its own list.
+
+  Requires the indent stack and the CompileState for the file.
   """
 
   indents = indents[:]
 
   compiled = []
 
+  if options.metrics:
+    label = metrics_label(compile_template_builder, tokens, options, state)
+
   tokens = consume_prefix(tokens, options.template_builder_open_left)
   # get the name of the result template
   template_name = tokens.pop(0).string
@@ -318,8 +1199,11 @@ def compile_template_builder(tokens, indents, options):
   if tokens[0] == tku.dtok.new(tk.OP, '@'):
     tokens.pop(0)
 
-  init_statement = tku.tokenize_stmt(f"{template_name} = []\n")
-  compiled.extend(init_statement)
+  init = f"{template_name} = []"
+  if options.metrics:
+    start_name = f"unplate_start_{template_name}"
+    init = f"{start_name} = unplate.metrics.clock(); {init}"
+  compiled.extend(tku.tokenize_stmt(init + '\n'))
 
   # Consume leading newline
   while tokens[0].type == tk.NEWLINE:
@@ -331,7 +1215,81 @@ def compile_template_builder(tokens, indents, options):
   # keep track of how many times we've indended in interpolated code
   interpolated_indent_depth = 0
 
-  for line in lines:
+  # The template being written to, and the nested builders currently open.
+  # Each nested builder is (name, target, indent depth when opened, fused)
+  target = template_name
+  nested = []
+
+  # pending index -> what is left of an interpolation line for a fused nested builder
+  fused_lines = {}
+
+  # nested builders which have been closed, and whose results are
+  # spliced in as they are when interpolated (see compile_chunks)
+  spliced = set()
+
+  def append_statement(chunks):
+    """ The statement appending the given chunks to the current target """
+
+    segments = []
+    if options.builder_output in ['chunks', 'rope']:
+      exprs = compile_chunks(chunks, options, keep_newlines=False,
+        ropes=options.builder_output == 'rope', segments=segments, spliced=spliced)
+      value = '[' + ', '.join(exprs) + ']'
+      method = 'extend'
+    else:
+      value = join_chunks(chunks, options, keep_newlines=False, segments=segments, spliced=spliced)
+      method = 'append'
+
+    # on the same line, so that line numbers still match the template
+    bindings = ''.join(f"{name} = {expr}; " for name, expr in segments)
+
+    content = tku.tokenize_expr(value)
+    # not entirely sure why the following line needs a trailing \n
+    pattern = tku.tokenize_stmt(f'{bindings}{target}.{method}(unplate_value)\n')
+    prefix, suffix = tku.split_pattern(pattern, 'unplate_value')
+    return prefix + content + suffix
+
+  minifier = Minifier(options) if options.minify else None
+
+  # the lines of this template, with includes expanded
+  expanded = []
+
+  # stack of lines still to compile; includes push onto it
+  pending = lines[::-1]
+
+  # how many includes are being compiled
+  including = 0
+
+  while pending:
+    index = len(pending) - 1
+    line = pending.pop()
+
+    if isinstance(line, IncludeEnd):
+      including -= 1
+      joined = single_line(compiled[line.start:])
+      if joined is None:
+        raise UnplateSyntaxError.from_token(body_token,
+          f"Cannot include {line.name!r}: an included template builder is compiled onto the line of the include, "
+          "so may only contain blocks which are simple for-loops, or a single block at its start.")
+      compiled[line.start:] = joined
+      continue
+
+    included_name = parse_include(line)
+    if included_name is not None:
+      included = state.include(included_name)
+      if included is None:
+        raise UnplateSyntaxError.from_token(body_token,
+          f"Cannot include {included_name!r}: no template builder of that name is defined above.")
+
+      # keep the indentation of the include line
+      indent = line[:len(line) - len(line.lstrip())]
+      pending.append(IncludeEnd(included_name, len(compiled)))
+      pending.extend(indent + included_line for included_line in reversed(included))
+      including += 1
+      continue
+
+    expanded.append(line)
+    line = fused_lines.pop(index, line)
 
     # interpolated python code
     if line.lstrip().startswith('>>>'):
@@ -340,6 +1298,65 @@ def compile_template_builder(tokens, indents, options):
         raise UnplateSyntaxError.from_token(body_token, "A space is required after '>>>'")
 
       python_code = line.lstrip()[len('>>> '):]
+
+      nested_name = parse_nested_begin(python_code, options)
+      if nested_name is not None:
+        fusion = None
+        if minifier is None:
+          fusion = plan_fusion(nested_name, pending, expanded, state, options)
+        spliced.discard(nested_name)
+
+        if fusion is not None:
+          fused_index, prefix, fused_lines[fused_index] = fusion
+          if prefix:
+            compiled.extend(append_statement(split_content(prefix, options)))
+          else:
+            compiled.append(tku.dtok.new(tk.NL, '\n'))
+          nested.append((nested_name, target, interpolated_indent_depth, True))
+        else:
+          compiled.extend(tku.tokenize_stmt(f"{nested_name} = []\n"))
+          nested.append((nested_name, target, interpolated_indent_depth, False))
+          target = nested_name
+        continue
+
+      if is_nested_end(python_code, options):
+        if not nested:
+          raise UnplateSyntaxError.from_token(body_token, "Nested template builder closed but never opened.")
+
+        nested_name, target, depth, fused = nested.pop()
+        if depth != interpolated_indent_depth:
+          raise UnplateSyntaxError.from_token(body_token,
+            f"Nested template builder {nested_name!r} must be closed at the same indentation it was opened.")
+
+        if not fused:
+          spliced.add(nested_name)
+
+        closing = not fused and closing_statement(nested_name, options)
+        if closing:
+          compiled.extend(tku.tokenize_stmt(closing + '\n'))
+        else:
+          compiled.append(tku.dtok.new(tk.NL, '\n'))
+        continue
+
+      # the statement may rebind a nested builder's result to anything
+      spliced.difference_update([name for name in spliced if re.search(rf'\b{name}\b', python_code)])
+
+      # included template builders must fit on one line (see single_line),
+      # so their simple loops and if-blocks are always lowered
+      lowered = None
+      if options.lower_loops or including:
+        body = simple_loop_body(python_code, pending)
+        lowered = body and compile_lowered_loop(target, python_code, body, options, minifier, spliced)
+      if including and not lowered:
+        body = simple_loop_body(python_code, pending, 'if')
+        lowered = body and compile_lowered_if(target, python_code, body, options, minifier, spliced)
+      if lowered:
+        compiled.extend(lowered)
+        # consume the body and the closing '<<<'
+        for _ in range(len(body) + 1):
+          expanded.append(pending.pop())
+        continue
+
       compiled.extend(tku.tokenize_stmt(python_code))
       compiled.append(tku.dtok.new(tk.NEWLINE, '\n'))
 
@@ -365,26 +1382,273 @@ def compile_template_builder(tokens, indents, options):
       interpolated_indent_depth -= 1
 
     else:
-      content = tku.tokenize_expr(compile_content(line, options) + " + '\\n'")
-      # not entirely sure why the following line needs a trailing \n
-      pattern = tku.tokenize_stmt(f'{template_name}.append(VALUE)\n')
-      prefix, suffix = tku.split_pattern(pattern, 'VALUE')
-      statement = prefix + content + suffix
-      compiled.extend(statement)
+      if minifier is not None:
+        line = minifier.line(line)
+        if line is None:
+          compiled.append(tku.dtok.new(tk.NL, '\n'))
+          continue
+
+      chunks = split_content(line + '\n', options)
+      compiled.extend(append_statement(chunks))
+
+  if nested:
+    raise UnplateSyntaxError.from_token(body_token, f"Nested template builder {nested[-1][0]!r} is never closed.")
 
   # consume the template closing syntax
   tokens = consume_prefix(tokens, options.template_builder_close)
 
-  closing_statement = tku.tokenize_stmt(f"{template_name} = ''.join({template_name})")
-  compiled.extend(closing_statement)
+  # blocks left open are closed by the end of the template, so close
+  # them explicitly for anything including this template
+  state.define(template_name, expanded + ['<<<'] * interpolated_indent_depth)
+
+  closing = closing_statement(template_name, options)
+  if options.metrics:
+    observe = f"unplate.metrics.observe({label!r}, {start_name}, {template_name})"
+    closing = f"{closing}; {observe}" if closing else observe
+  if closing:
+    compiled.extend(tku.tokenize_stmt(closing))
 
   return compiled, tokens
 
 
-def compile_tokens(tokens, options):
+def region_length(tokens, options):
+  """
+  Given tokens beginning with a template literal or template builder,
+  return the number of tokens making up that template, without compiling it.
+  Returns None if the template is malformed; compiling it will give the error.
+  """
+
+  if util.prefix_is(tokens, options.template_literal_open):
+    i = len(options.template_literal_open)
+    if i < len(tokens) and tokens[i].type == tk.STRING:
+      i += 1
+    else:
+      while i < len(tokens) and tokens[i].type in [tk.NL, tk.COMMENT]:
+        i += 1
+    close = options.template_literal_close
+
+  elif util.prefix_is(tokens, options.template_builder_open_left):
+    close = options.template_builder_close
+    i = len(options.template_builder_open_left)
+    while i < len(tokens) and tokens[i : i + len(close)] != close:
+      i += 1
+
+  else:
+    return None
+
+  if tokens[i : i + len(close)] != close:
+    return None
+
+  return i + len(close)
+
+
+def metrics_label(compile_template, tokens, options, state):
+  """
+  The (file, template) label under which options.metrics records renders
+  of the template at the start of `tokens`. Templates are labelled by the
+  line they start on, and template builders also by name: names such as
+  `result` are often reused, so do not tell builders apart on their own.
+  """
+
+  file = state.file_loc or '<unknown>'
+  line = f'line {tokens[0].start[0]}'
+  if compile_template is compile_template_builder:
+    return (file, f'{tokens[len(options.template_builder_open_left)].string} ({line})')
+  return (file, line)
+
+
+def expand_partial(lines, state, body_token):
+  """
+  Without compiling, work out what compile_template_builder would define
+  as the partial for a template builder with the given lines.
+  Returns (the partial's lines, {included name: lines}).
+  """
+
+  expanded = []
+  included = {}
+  depth = 0
+
+  for line in lines:
+    included_name = parse_include(line)
+    if included_name is not None:
+      included_lines = state.include(included_name)
+      if included_lines is None:
+        raise UnplateSyntaxError.from_token(body_token,
+          f"Cannot include {included_name!r}: no template builder of that name is defined above.")
+      included[included_name] = included_lines
+      indent = line[:len(line) - len(line.lstrip())]
+      new_lines = [indent + included_line for included_line in included_lines]
+    else:
+      new_lines = [line]
+
+    for new_line in new_lines:
+      stripped = new_line.strip()
+      if stripped.startswith('>>> ') and stripped.endswith(':'):
+        depth += 1
+      elif stripped == '<<<':
+        depth -= 1
+    expanded.extend(new_lines)
+
+  return expanded + ['<<<'] * max(depth, 0), included
+
+
+# expressions which cannot run inside eval() or exec()
+eager_expression = re.compile(r'\b(yield|await)\b')
+
+
+def needs_eager_builder(lines):
+  """
+  Whether the `>>>` code of a template builder, given its lines, cannot
+  run inside unplate.lazy.build(): because it returns, yields, awaits or
+  breaks out of a loop around the template, or declares names global or
+  nonlocal. Template lines count as `pass`.
+
+  The code is rebuilt as a module and compiled, which rejects all of
+  these but `global`; that is found in the syntax tree.
+  """
+
+  code_lines = []
+  depth = 0
+  for line in lines:
+    stripped = line.strip()
+    if stripped.startswith('>>> '):
+      code_lines.append('  ' * depth + stripped[len('>>> '):])
+      if stripped.endswith(':'):
+        depth += 1
+    elif stripped == '<<<':
+      depth -= 1
+    else:
+      code_lines.append('  ' * depth + 'pass')
+
+  code = '\n'.join(code_lines) + '\n'
+  try:
+    builtins.compile(code, '<unplate>', 'exec', dont_inherit=True)
+  except (SyntaxError, ValueError):
+    # the eager compilation will report real errors
+    return True
+
+  return any(isinstance(node, ast.Global) for node in ast.walk(ast.parse(code)))
+
+
+def compile_lazy(compile_template, tokens, indents, options, state):
+  """
+  For options.lazy, compile the template at the start of `tokens` to a
+  stub which compiles and runs the template when it is first executed
+  (see unplate.lazy). Templates which could not run that way are
+  compiled now, with `compile_template`.
+
+  Template builders are stubbed as
+
+    template_name = unplate.lazy.build(ID, globals(), locals())
+
+  and template literals as
+
+    unplate.lazy.render(ID, globals(), locals())
+
+  padded with newlines to preserve line numbers.
+  Returns the same as `compile_template`.
+  """
+
+  length = region_length(tokens, options)
+  if length is None:
+    return compile_template(tokens, indents, options, state)
+
+  region_tokens = tokens[:length]
+  rest = tokens[length:]
+
+  if compile_template is compile_template_builder:
+    kind = 'builder'
+    left, right = options.template_builder_open_left, options.template_builder_open_right
+    name = region_tokens[len(left)].string
+
+    # as in compile_template_builder
+    body_tokens = region_tokens[len(left) + 1 + len(right):]
+    if body_tokens[0] == tku.dtok.new(tk.OP, '@'):
+      body_tokens = body_tokens[1:]
+    while body_tokens[0].type == tk.NEWLINE:
+      body_tokens = body_tokens[1:]
+
+    lines, _ = read_template_body(body_tokens, indents, options)
+    lines, included = expand_partial(lines, state, body_tokens[0])
+
+    if needs_eager_builder(lines):
+      return compile_template(tokens, indents, options, state)
+
+  else:
+    kind = 'literal'
+    name = None
+    included = {}
+    lines, _ = read_template_body(region_tokens[len(options.template_literal_open):], indents, options)
+
+  if any(eager_expression.search(line) for line in lines):
+    return compile_template(tokens, indents, options, state)
+
+  if kind == 'builder':
+    state.define(name, lines)
+
+  eager_options = copy.copy(options)
+  eager_options.lazy = False
+
+  lazy = unplate.load('lazy')
+  region = lazy.Region(kind, name, region_tokens, indents[:], eager_options, included, state.file_loc, state.word_counts())
+  # Identified by content rather than position, so that edits elsewhere in
+  # the file do not register it again, and by which occurrence of that
+  # content it is, so that identical templates in a file stay apart
+  content = (
+    tuple((tok.type, tok.string) for tok in region_tokens),
+    tuple(indents),
+    tuple((included_name, tuple(included_lines)) for included_name, included_lines in sorted(included.items())),
+  )
+  ordinal = state.occurrences[content]
+  state.occurrences[content] += 1
+  identity = (state.file_loc, content, ordinal, options.key())
+  id = lazy.register(identity, region)
+
+  if kind == 'builder':
+    stub = tku.tokenize_expr(f"{name} = unplate.lazy.build({id}, globals(), locals())")
+  else:
+    stub = tku.tokenize_expr(f"(unplate.lazy.render({id}, globals(), locals()))")
+
+  # Pad to preserve line numbers
+  newlines = region_tokens[-1].end[0] - region_tokens[0].start[0]
+  compiled = stub[:-1] + [tku.dtok.new(tk.NL, '\n')] * newlines + stub[-1:]
+
+  return compiled, rest
+
+
+def region_event(compile_template, region_tokens, rest_tokens, compiled_tokens, duration, options):
+  """ Describe a compiled template for unplate.trace """
+
+  consumed = region_tokens[:len(region_tokens) - len(rest_tokens)]
+
+  if compile_template is compile_template_builder:
+    kind = 'builder'
+    name = region_tokens[len(options.template_builder_open_left)].string
+  else:
+    kind = 'literal'
+    name = None
+
+  return trace.RegionEvent(
+    kind            = kind,
+    name            = name,
+    lineno          = consumed[0].start[0],
+    lines           = consumed[-1].end[0] - consumed[0].start[0] + 1,
+    tokens          = len(consumed),
+    compiled_tokens = len(compiled_tokens),
+    duration        = duration,
+  )
+
+
+def compile_tokens(tokens, options, *, file_loc=None, cache=None, event=None):
   """
   Given Python tokens that represent Python + Unplate code, compile the Unplate code and return results.
   Results will be a mix of unmodified tokens and raw Python code (as strings).
+
+  If a cache is given (see unplate.reload.RegionCache), templates that it
+  has already seen are not recompiled.
+
+  If a trace event is given (see unplate.trace), a RegionEvent is
+  recorded into it for each template.
   """
 
   compiled = []
@@ -396,17 +1660,36 @@ def compile_tokens(tokens, options):
   # off of the stack
   indents = []
 
+  state = CompileState(file_loc, tokens)
+
   while tokens:
     token = tokens[0]
 
+    compile_template = None
     if util.prefix_is(tokens, options.template_literal_open):
-      compiled_toks, tokens = compile_template_literal(tokens, indents, options)
-      compiled.extend(compiled_toks)
-
+      compile_template = compile_template_literal
     elif util.prefix_is(tokens, options.template_builder_open_left):
-      compiled_toks, tokens = compile_template_builder(tokens, indents, options)
+      compile_template = compile_template_builder
+
+    if compile_template is not None:
+      if event is not None:
+        region_tokens = tokens
+        start_time = time.perf_counter()
+
+      if options.lazy:
+        compiled_toks, tokens = compile_lazy(compile_template, tokens, indents, options, state)
+      elif cache is None:
+        compiled_toks, tokens = compile_template(tokens, indents, options, state)
+      else:
+        compiled_toks, tokens = cache.compile(compile_template, tokens, indents, options, state)
       compiled.extend(compiled_toks)
 
+      if event is not None:
+        event.regions.append(region_event(
+          compile_template, region_tokens, tokens, compiled_toks,
+          time.perf_counter() - start_time, options,
+        ))
+
     if token.type == tk.INDENT:
       indents.append(token.string)
       compiled.append(tokens.pop(0))
@@ -0,0 +1,201 @@
+import hashlib
+import marshal
+import os
+import stat
+import sys
+import threading
+
+try:
+  import fcntl
+except ImportError:  # e.g. on Windows
+  fcntl = None
+
+"""
+
+Single-flight compilation, for unplate.compile().
+
+When many threads call unplate.compile() on the same file at once, e.g.
+while a threaded server imports its modules, only the first compiles it;
+the others wait for and share its result. Results are kept, so compiling
+an unchanged file again only costs reading it. Files are identified by
+their absolute path, modification time, size and a hash of their
+contents -- timestamps may be too coarse to tell quick edits apart --
+together with the compilation options.
+
+To do the same across processes, e.g. forked workers, set a cache
+directory:
+
+  unplate.coordinator.coordinator.cache_dir = os.path.join(app_dir, '.unplate-cache')
+
+Compiled code is then stored there, and processes take a file lock on a
+file before compiling it, so that one process compiles it and the others
+load the result. Where file locks are unavailable (no fcntl), processes
+still share the cache, but may compile a file more than once.
+
+Code in the cache directory is run, so it must not be writable by anyone
+else: it is created readable by its owner only, and a directory which
+belongs to another user or which others may write to is refused.
+
+"""
+
+
+class Flight:
+  """ A compilation in progress, which other threads may wait on """
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+  def finish(self, result=None, error=None):
+    self.result = result
+    self.error = error
+    self.done.set()
+
+  def wait(self):
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+
+class Coordinator:
+  """
+  Deduplicates compilations of the same file with the same options.
+
+    cache_dir   if not None, a directory through which processes share
+                compiled code; see the module docstring
+  """
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = cache_dir
+    self.lock = threading.Lock()
+    # key -> Flight, for compilations in progress
+    self.flights = {}
+    # (path, options key) -> (stamp, compiled code), for the latest version of each file
+    self.results = {}
+
+  def compile(self, file_loc, options, compile_function):
+    """
+    Return compile_function(file_loc, options), reusing the result of an
+    earlier or in-progress call for the same version of the same file.
+    Errors are not reused: every caller waiting on a compilation which
+    fails gets its error, and the next call tries again.
+    """
+
+    path = os.path.abspath(file_loc)
+    stamp = file_stamp(path)
+    options_key = options.key()
+    key = (path, stamp, options_key)
+
+    with self.lock:
+      result = self.results.get((path, options_key))
+      if result is not None and result[0] == stamp:
+        return result[1]
+
+      flight = self.flights.get(key)
+      leading = flight is None
+      if leading:
+        flight = self.flights[key] = Flight()
+
+    if not leading:
+      return flight.wait()
+
+    try:
+      # lazy templates refer to regions registered in this process
+      if self.cache_dir is None or options.lazy:
+        compiled = compile_function(file_loc, options)
+      else:
+        compiled = self.compile_shared(file_loc, options, key, compile_function)
+    except BaseException as error:
+      with self.lock:
+        del self.flights[key]
+      flight.finish(error=error)
+      raise
+
+    with self.lock:
+      del self.flights[key]
+      self.results[(path, options_key)] = (stamp, compiled)
+    flight.finish(compiled)
+
+    return compiled
+
+  def compile_shared(self, file_loc, options, key, compile_function):
+    """ Compile through the cache directory, holding a file lock for the file """
+
+    check_cache_dir(self.cache_dir)
+    cache_loc = os.path.join(self.cache_dir, f"{os.path.basename(file_loc)}.{cache_digest(key)}")
+
+    with open(cache_loc + '.lock', 'a') as lock_file:
+      if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        compiled = read_cached(cache_loc)
+        if compiled is None:
+          compiled = compile_function(file_loc, options)
+          write_cached(cache_loc, compiled)
+        return compiled
+      finally:
+        if fcntl is not None:
+          fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def file_stamp(path):
+  """ Identify the current version of the file at `path` """
+  with open(path, 'rb') as f:
+    info = os.fstat(f.fileno())
+    digest = hashlib.sha256(f.read()).hexdigest()
+  return (info.st_mtime_ns, info.st_size, digest)
+
+
+def check_cache_dir(cache_dir):
+  """
+  Create the cache directory if need be, and raise PermissionError if
+  anyone but the current user could put code into it
+  """
+
+  os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+  # no owners to check on Windows
+  if not hasattr(os, 'getuid'):
+    return
+
+  info = os.stat(cache_dir)
+  if not stat.S_ISDIR(info.st_mode):
+    raise PermissionError(f"Unplate cache directory {cache_dir!r} is not a directory")
+  if info.st_uid != os.getuid():
+    raise PermissionError(f"Unplate cache directory {cache_dir!r} belongs to another user")
+  if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    raise PermissionError(f"Unplate cache directory {cache_dir!r} is writable by other users")
+
+
+def cache_digest(key):
+  """
+  Name the compiled code for `key` in a cache directory. Includes the
+  Python version, as the code is marshalled, and the version of Unplate's
+  compiler, as a changed compiler may compile differently.
+  """
+  compiler_loc = os.path.join(os.path.dirname(__file__), 'compile.py')
+  compiler_stamp = os.stat(compiler_loc).st_mtime_ns
+  identity = repr((key, compiler_stamp, sys.implementation.cache_tag))
+  return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+
+
+def read_cached(cache_loc):
+  """ Return the code cached at `cache_loc`, or None if there is none """
+  try:
+    with open(cache_loc, 'rb') as f:
+      return marshal.load(f)
+  except (OSError, EOFError, ValueError, TypeError):
+    return None
+
+
+def write_cached(cache_loc, compiled):
+  # write then rename, so that readers never see a partial file
+  temp_loc = f"{cache_loc}.{os.getpid()}.{threading.get_ident()}.tmp"
+  with open(temp_loc, 'wb') as f:
+    marshal.dump(compiled, f)
+  os.replace(temp_loc, cache_loc)
+
+
+coordinator = Coordinator()
@@ -0,0 +1,136 @@
+import builtins
+import threading
+import types
+
+import unplate
+import unplate.tokenize_util as tku
+
+# not `import unplate.compile`, which would give the function unplate.compile
+unplate_compile = unplate.load('compile')
+
+"""
+
+Lazy template compilation, for options.lazy = True.
+
+Each template is compiled to a stub which calls render() (for template
+literals) or build() (for template builders) with the id of a Region
+registered here. The Region keeps the template's source tokens; the first
+time the stub runs, the template is compiled, and the resulting code
+object is kept for later renders.
+
+"""
+
+
+class Region:
+  """
+  A template whose compilation has been deferred.
+
+    kind        'literal' or 'builder'
+    name        the name of the template builder; None for literals
+    tokens      the source tokens of the template
+    indents     the indent stack where the template occurs
+    options     the options to compile it with
+    partials    the template builders it includes, by name (see CompileState)
+    file_loc    the file it occurs in
+    words       the words of the file it occurs in (see CompileState.mentions)
+  """
+
+  def __init__(self, kind, name, tokens, indents, options, partials, file_loc, words=None):
+    self.kind = kind
+    self.name = name
+    self.tokens = tokens
+    self.indents = indents
+    self.options = options
+    self.partials = partials
+    self.file_loc = file_loc
+    self.words = words
+    self.code = None
+    self.scoped = False
+    self.lock = threading.Lock()
+
+  def compiled(self):
+    """ Return the code object of the template, compiling it on first use """
+
+    code = self.code
+    if code is not None:
+      return code
+
+    with self.lock:
+      if self.code is None:
+        code = self.compile()
+        # Code with scopes of its own, like comprehensions, cannot see names
+        # in the `locals` of eval() and exec(), so is run in a merged namespace
+        self.scoped = any(isinstance(const, types.CodeType) for const in code.co_consts)
+        self.code = code
+      return self.code
+
+  def compile(self):
+    state = unplate_compile.CompileState(self.file_loc)
+    state.partials = dict(self.partials)
+    state.words = self.words
+
+    if self.kind == 'literal':
+      compile_template, mode = unplate_compile.compile_template_literal, 'eval'
+    else:
+      compile_template, mode = unplate_compile.compile_template_builder, 'exec'
+
+    try:
+      compiled, rest = compile_template(list(self.tokens), list(self.indents), self.options, state)
+    except unplate_compile.UnplateSyntaxError as err:
+      err.file_loc = self.file_loc
+      raise err
+
+    # pad with newlines so that line numbers match the file
+    lineno = self.tokens[0].start[0]
+    python_code = '\n' * (lineno - 1) + tku.untokenize(compiled).lstrip() + '\n'
+    return builtins.compile(python_code, self.file_loc or '<unplate>', mode)
+
+
+# Registered regions; a region's id is its index
+regions = []
+# identity of a region -> its id, so that recompiling a file does not register its templates again.
+# Identities do not include where the template is, so that editing around it does not either
+# (see unplate.compile.compile_lazy).
+ids = {}
+lock = threading.Lock()
+
+
+def register(identity, region):
+  """
+  Register a Region, returning its id. A region with the same identity
+  as one already registered takes its id, replacing it if it has moved,
+  so that line numbers stay those of the latest compilation.
+  """
+  with lock:
+    id = ids.get(identity)
+    if id is None:
+      id = ids[identity] = len(regions)
+      regions.append(region)
+    elif regions[id].tokens[0].start != region.tokens[0].start:
+      regions[id] = region
+    return id
+
+
+def render(id, globals, locals):
+  """ Render the template literal `id` in the given namespace """
+  region = regions[id]
+  code = region.compiled()
+  if region.scoped:
+    return eval(code, {**globals, **locals})
+  return eval(code, globals, locals)
+
+
+def build(id, globals, locals):
+  """
+  Run the template builder `id` in a copy of the given namespace,
+  returning its result. Names it binds are not kept.
+  """
+  region = regions[id]
+  code = region.compiled()
+  if region.scoped:
+    namespace = {**globals, **locals}
+    exec(code, namespace)
+  else:
+    namespace = dict(locals)
+    exec(code, globals, namespace)
+  return namespace[region.name]
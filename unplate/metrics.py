@@ -0,0 +1,188 @@
+from bisect import bisect_left
+import threading
+import time
+
+"""
+
+Runtime render metrics, for options.metrics = True.
+
+Templates compiled with metrics on record each render into `registry`:
+how many times each template rendered, and histograms of how long the
+renders took and how large their output was.
+
+  unplate.metrics.registry.as_dict()
+  unplate.metrics.registry.prometheus()   # Prometheus text exposition format
+
+Templates are labelled by file and by the line they start on, and
+template builders also by name, e.g. 'result (line 12)'. Memory is bounded: each
+template has a fixed number of buckets, and at most `registry.maxsize`
+templates are tracked, after which renders are counted under
+OVERFLOW_LABEL.
+
+"""
+
+clock = time.perf_counter
+
+# Upper bounds of the histogram buckets. Each histogram also has a +Inf bucket.
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)  # seconds
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)  # characters, or bytes
+
+OVERFLOW_LABEL = ('<other>', '<other>')
+
+
+class Histogram:
+  """
+  Counts of observed values falling into fixed buckets.
+
+    buckets   the upper bounds of the buckets, ascending
+    counts    the number of values in each bucket, plus one for +Inf;
+              not cumulative
+    sum       the sum of the values
+    count     the number of values
+  """
+
+  __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def as_dict(self):
+    return {
+      'buckets': list(self.buckets),
+      'counts': list(self.counts),
+      'sum': self.sum,
+      'count': self.count,
+    }
+
+
+class TemplateMetrics:
+  """ The metrics of one template """
+
+  __slots__ = ['latency', 'size', 'lock']
+
+  def __init__(self):
+    self.latency = Histogram(LATENCY_BUCKETS)
+    self.size = Histogram(SIZE_BUCKETS)
+    self.lock = threading.Lock()
+
+  @property
+  def renders(self):
+    return self.latency.count
+
+  def observe(self, duration, size):
+    # Histogram.observe() inlined, as this runs on every render
+    latency, sizes = self.latency, self.size
+    with self.lock:
+      latency.counts[bisect_left(LATENCY_BUCKETS, duration)] += 1
+      latency.sum += duration
+      latency.count += 1
+      sizes.counts[bisect_left(SIZE_BUCKETS, size)] += 1
+      sizes.sum += size
+      sizes.count += 1
+
+  def snapshot(self):
+    """ Return (latency, size) as dicts """
+    with self.lock:
+      return self.latency.as_dict(), self.size.as_dict()
+
+
+def output_size(value):
+  """
+  The size of a rendered template: its length, for str or bytes.
+  For builder_output = 'chunks' or 'rope', the total length of the
+  template's own pieces; nested Ropes are counted by their own templates.
+  """
+  if isinstance(value, (str, bytes)):
+    return len(value)
+  return sum(len(piece) for piece in getattr(value, 'parts', value) if isinstance(piece, (str, bytes)))
+
+
+class Registry:
+  """
+  Render metrics of each template, keyed on (file, template) labels.
+  Safe to use from multiple threads.
+  """
+
+  def __init__(self, maxsize=10_000):
+    self.maxsize = maxsize
+    self.templates = {}
+    self.lock = threading.Lock()
+
+  def observe(self, label, start, value):
+    """
+    Record a render of the template `label` which began at `start`
+    (according to `clock`) and produced `value`. Returns `value`.
+    """
+
+    duration = clock() - start
+    metrics = self.templates.get(label)
+    if metrics is None:
+      metrics = self.add(label)
+    metrics.observe(duration, len(value) if type(value) is str else output_size(value))
+    return value
+
+  def add(self, label):
+    """ Start tracking the template `label`, unless there are too many already """
+    with self.lock:
+      if label not in self.templates and len(self.templates) >= self.maxsize:
+        label = OVERFLOW_LABEL
+      return self.templates.setdefault(label, TemplateMetrics())
+
+  def reset(self):
+    with self.lock:
+      self.templates.clear()
+
+  def collect(self):
+    """ Return [((file, template), latency dict, size dict)] """
+    with self.lock:
+      templates = list(self.templates.items())
+    return [(label, *metrics.snapshot()) for label, metrics in templates]
+
+  def as_dict(self):
+    """ Return {'file:template': {'renders', 'latency', 'size'}} """
+    return {
+      f'{file}:{template}': {'renders': latency['count'], 'latency': latency, 'size': size}
+      for (file, template), latency, size in self.collect()
+    }
+
+  def prometheus(self):
+    """ Return the metrics in the Prometheus text exposition format """
+
+    templates = self.collect()
+
+    lines = []
+    for index, (name, description) in enumerate([
+      ('unplate_render_seconds', 'Time taken to render Unplate templates'),
+      ('unplate_render_size', 'Length of rendered Unplate templates'),
+    ]):
+      lines.append(f'# HELP {name} {description}')
+      lines.append(f'# TYPE {name} histogram')
+      for (file, template), *histograms in templates:
+        histogram = histograms[index]
+        labels = f'file="{escape_label(file)}",template="{escape_label(template)}"'
+        cumulative = 0
+        for bound, count in zip([*histogram['buckets'], '+Inf'], histogram['counts']):
+          cumulative += count
+          lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram["sum"]}')
+        lines.append(f'{name}_count{{{labels}}} {histogram["count"]}')
+
+    return ''.join(line + '\n' for line in lines)
+
+
+def escape_label(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+# Called by compiled templates
+observe = registry.observe
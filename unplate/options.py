@@ -1,5 +1,5 @@
+import tokenize as tk
 import unplate.tokenize_util as tku
-import unplate.util
 
 class Options:
   """
@@ -35,19 +35,195 @@ class Options:
       default: '}}'
       The string that signifies the end of an interpoalted Python expression
 
+    output_bytes
+      default: False
+      If true, templates produce bytes instead of str. Static text is encoded
+      once, at compile time; only interpolated values are encoded when rendering.
+      Interpolated values which are already bytes, e.g. other templates, are
+      used as they are
+
+    encoding
+      default: 'utf-8'
+      The encoding used for output_bytes
+
+    builder_output
+      default: 'joined'
+      What a template builder leaves in its variable. One of
+        'joined': the rendered template, as a single str (or bytes)
+        'chunks': the list of rendered pieces, without a final concatenation.
+                  Suitable for e.g. file.writelines() or socket.sendmsg()
+        'rope':   an unplate.rope.Rope of the pieces. Ropes interpolated into
+                  other template builders are kept as pieces rather than
+                  converted to str, so nested and recursive templates copy
+                  nothing until the outermost Rope is converted or written.
+                  The code must have `unplate` imported
+
+    lower_loops
+      default: False
+      If true, for-loops in template builders whose bodies are only template
+      lines (no '>>>' statements) are compiled to a single
+        template.extend([<line> for row in rows])
+      rather than a Python loop which appends on each iteration.
+      This is faster, but the loop runs as a list comprehension, so:
+        - the loop variable is not left defined after the loop
+        - like any comprehension, the body cannot see names from an
+          enclosing class body, nor names only in the `locals` passed to exec()
+
+    fold_constants
+      default: False
+      If true, interpolations whose values can be computed at compile time,
+      like {{ '-' * 80 }}, are rendered during compilation and become part
+      of the static text. Only literals, operators, a few str methods, and
+      names in `constants` are considered constant.
+
+    constants
+      default: {}
+      Names which fold_constants may treat as constants, and their values.
+      These must really be constant: if a template interpolates a name listed
+      here, the value given here is used, regardless of what the name refers
+      to at runtime.
+
+    minify
+      default: False
+      If true, insignificant whitespace is removed from the static text of
+      templates at compile time, for HTML and XML output: runs of whitespace
+      become a single space, lines are stripped, and blank lines are dropped.
+      Interpolated values, and the contents of <pre>, <textarea>, <script>
+      and <style>, are left as they are.
+
+    metrics
+      default: False
+      If true, every render of every template is recorded into
+      unplate.metrics.registry: a count, and histograms of render time and
+      output size, labelled by file and template name (or line, for template
+      literals). Template builders keep their start time in a variable named
+      `unplate_start_<name>`. Renders which raise are not recorded.
+      The code must have `unplate` imported
+
+    lazy
+      default: False
+      If true, templates are not compiled along with the rest of the file.
+      Instead each template compiles to a small stub, which compiles the
+      template the first time it runs and keeps the result, so only the
+      templates which are actually used are ever compiled.
+      The stub runs the template with eval() or exec() in the namespace
+      given by globals() and locals(), so:
+        - names which a template builder binds, e.g. with `>>> x = 1` or
+          a for-loop, are not left defined after it
+        - templates cannot see names from enclosing functions unless the
+          function containing the template also uses them outside templates
+        - Unplate syntax errors in a template are raised when it first runs
+      Templates which could not run this way, e.g. those with a `>>> return`
+      or `await`, are compiled up front as usual. Lazy templates are not
+      kept by unplate.reload.RegionCache or in unplate.coordinator's
+      cache_dir, as the stubs refer to templates registered in this process.
+      The code must have `unplate` imported
+
 
   """
 
   def __init__(self):
 
-    template_literal_pattern = tku.tokenize_expr('unplate.template(\nBODY)')
-    self.template_literal_open, self.template_literal_close = tku.split_pattern(template_literal_pattern, 'BODY')
+    self.template_literal_open = tokens_from_table(TEMPLATE_LITERAL_OPEN)
+    self.template_literal_close = tokens_from_table(TEMPLATE_LITERAL_CLOSE)
 
-    template_builder_open_pattern = tku.tokenize_expr("[unplate.begin(NAME)]")
-    self.template_builder_open_left, self.template_builder_open_right = tku.split_pattern(template_builder_open_pattern, 'NAME')
-    self.template_builder_close = tku.tokenize_expr('[unplate.end]')
+    self.template_builder_open_left = tokens_from_table(TEMPLATE_BUILDER_OPEN_LEFT)
+    self.template_builder_open_right = tokens_from_table(TEMPLATE_BUILDER_OPEN_RIGHT)
+    self.template_builder_close = tokens_from_table(TEMPLATE_BUILDER_CLOSE)
 
     self.interpolation_open = '{{'
     self.interpolation_close = '}}'
 
+    self.output_bytes = False
+    self.encoding = 'utf-8'
+    self.builder_output = 'joined'
+    self.lower_loops = False
+    self.fold_constants = False
+    self.constants = {}
+    self.minify = False
+    self.metrics = False
+    self.lazy = False
+
+  def validate(self):
+    """ Raise ValueError if an option has a value Unplate does not know """
+    if self.builder_output not in BUILDER_OUTPUTS:
+      raise ValueError(f"Unknown builder_output {self.builder_output!r}; expected one of {BUILDER_OUTPUTS}")
+
+  def key(self):
+    """
+    Return a hashable summary of these options, for use in cache keys.
+    Two Options with equal keys compile code identically.
+    """
+    return tuple(sorted(
+      (name, freeze(value)) for name, value in vars(self).items()
+    ))
+
+
+# The possible values of Options.builder_output
+BUILDER_OUTPUTS = ['joined', 'chunks', 'rope']
+
+
+def freeze(value):
+  """
+  Return a hashable equivalent of an option value. Values which are
+  unhashable and not a list, tuple, dict or set (e.g. a constant which
+  is some mutable object) are compared by identity.
+  """
+  if isinstance(value, tku.dtok):
+    return (value.type, value.string)
+  if isinstance(value, (list, tuple)):
+    return tuple(freeze(item) for item in value)
+  if isinstance(value, dict):
+    return tuple(sorted(((key, freeze(item)) for key, item in value.items()), key=repr))
+  if isinstance(value, (set, frozenset)):
+    return (type(value).__name__, tuple(sorted((freeze(item) for item in value), key=repr)))
+  try:
+    hash(value)
+  except TypeError:
+    return ('id', type(value).__name__, id(value))
+  return value
+
+
+"""
+
+Default delimiter tables.
+
+These are the tokenizations of
+
+  unplate.template(
+  BODY)
+
+and
+
+  [unplate.begin(NAME)]
+  [unplate.end]
+
+written out by hand so that no tokenizing needs to happen at import time.
+test_unplate.py checks them against the tokenizer.
+
+"""
+
+TEMPLATE_LITERAL_OPEN = (
+  (tk.NAME, 'unplate'), (tk.OP, '.'), (tk.NAME, 'template'), (tk.OP, '('), (tk.NL, '\n'),
+)
+TEMPLATE_LITERAL_CLOSE = (
+  (tk.OP, ')'),
+)
+
+TEMPLATE_BUILDER_OPEN_LEFT = (
+  (tk.OP, '['), (tk.NAME, 'unplate'), (tk.OP, '.'), (tk.NAME, 'begin'), (tk.OP, '('),
+)
+TEMPLATE_BUILDER_OPEN_RIGHT = (
+  (tk.OP, ')'), (tk.OP, ']'),
+)
+TEMPLATE_BUILDER_CLOSE = (
+  (tk.OP, '['), (tk.NAME, 'unplate'), (tk.OP, '.'), (tk.NAME, 'end'), (tk.OP, ']'),
+)
+
+
+def tokens_from_table(table):
+  """ Turn a table of (type, string) pairs into a fresh list of dtoks """
+  return [tku.dtok.new(type, string) for type, string in table]
+
+
 defaults = Options()
@@ -0,0 +1,162 @@
+import builtins
+import collections
+import os
+import threading
+import traceback
+
+import unplate
+
+# not `import unplate.compile`, which would give the function unplate.compile
+unplate_compile = unplate.load('compile')
+
+"""
+
+Development-time hot reloading.
+
+A RegionCache remembers the compiled output of each template, keyed on the
+template's source tokens, so that recompiling a file after an edit only
+recompiles the templates that actually changed.
+
+A Watcher polls the source files of Unplate modules and, when one changes,
+recompiles it through a RegionCache and re-executes it in place.
+
+"""
+
+
+class RegionCache:
+  """
+  Cache of compiled templates, to be passed to unplate.compile_code(cache=...).
+
+  Entries are keyed on the kind of template, its source tokens, the
+  surrounding indentation, and the compilation options. At most
+  `maxsize` entries are kept; the least recently used are dropped first.
+  """
+
+  def __init__(self, maxsize=1024):
+    self.maxsize = maxsize
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def compile(self, compile_template, tokens, indents, options, state):
+    """
+    Compile the template at the start of `tokens` with `compile_template`
+    (compile_template_literal or compile_template_builder), reusing the
+    cached result if the template has been compiled before.
+    Returns the same as `compile_template`.
+
+    A cached template builder is only reused if the partials it included
+    are unchanged, and names it assumed unused elsewhere in the file still are.
+    """
+
+    length = unplate_compile.region_length(tokens, options)
+    if length is None:
+      return compile_template(tokens, indents, options, state)
+
+    region = tuple((tok.type, tok.string) for tok in tokens[:length])
+    key = (compile_template.__name__, region, tuple(indents), options.key())
+    if options.metrics:
+      # the compiled code includes the label, which depends on the position
+      key += (unplate_compile.metrics_label(compile_template, tokens, options, state),)
+
+    entry = self.entries.get(key)
+    if entry is not None:
+      compiled, used, unused_after, defined = entry
+      rest = tokens[length:]
+      if (all(state.partials.get(name) == lines for name, lines in used.items())
+          and all(state.mentions(name) == 2 for name in unused_after)):
+        self.hits += 1
+        self.entries.move_to_end(key)
+        state.partials.update(defined)
+        state.unused_after.update(unused_after)
+        return compiled, rest
+
+    self.misses += 1
+    state.used_partials = {}
+    unused_before = set(state.unused_after)
+    partials_before = dict(state.partials)
+    compiled, rest = compile_template(tokens, indents, options, state)
+    unused_after = state.unused_after - unused_before
+    defined = {
+      name: lines for name, lines in state.partials.items()
+      if partials_before.get(name) is not lines
+    }
+
+    if len(tokens) - len(rest) == length:
+      self.entries[key] = (compiled, state.used_partials, unused_after, defined)
+      self.entries.move_to_end(key)
+      if len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+    return compiled, rest
+
+
+class Watcher:
+  """
+  Watch the source files of Unplate modules and re-execute a module
+  whenever its file changes.
+
+  Call poll() periodically from your own loop, or use run() or start()
+  to poll every `interval` seconds. `on_reload` is called with each
+  module that has been re-executed.
+  """
+
+  def __init__(self, modules, options=None, *, interval=0.5, on_reload=None):
+    self.modules = list(modules)
+    self.options = options
+    self.interval = interval
+    self.on_reload = on_reload
+    self.cache = RegionCache()
+    self.mtimes = {module.__file__: os.stat(module.__file__).st_mtime_ns for module in self.modules}
+    self.stopped = threading.Event()
+
+  def reload(self, module):
+    """ Recompile and re-execute a module in its existing namespace """
+
+    file_loc = module.__file__
+    with open(file_loc, 'r') as f:
+      code = f.read()
+
+    python_code = unplate.compile_code(code, self.options, file_loc=file_loc, cache=self.cache)
+    exec(builtins.compile(python_code, file_loc, 'exec'), module.__dict__)
+
+    if self.on_reload is not None:
+      self.on_reload(module)
+
+  def poll(self):
+    """ Reload any modules whose files have changed. Return the reloaded modules. """
+
+    reloaded = []
+    for module in self.modules:
+      file_loc = module.__file__
+      mtime = os.stat(file_loc).st_mtime_ns
+      if mtime != self.mtimes[file_loc]:
+        self.mtimes[file_loc] = mtime
+        self.reload(module)
+        reloaded.append(module)
+
+    return reloaded
+
+  def run(self):
+    """ Poll until stop() is called. Errors are printed, not raised. """
+    while not self.stopped.wait(self.interval):
+      try:
+        self.poll()
+      except Exception:
+        traceback.print_exc()
+
+  def start(self):
+    """ Run in a background daemon thread """
+    thread = threading.Thread(target=self.run, daemon=True)
+    thread.start()
+    return thread
+
+  def stop(self):
+    self.stopped.set()
+
+
+def watch(*modules, options=None, interval=0.5, on_reload=None):
+  """ Watch the given modules in a background thread. Returns the Watcher. """
+  watcher = Watcher(modules, options, interval=interval, on_reload=on_reload)
+  watcher.start()
+  return watcher
@@ -0,0 +1,85 @@
+"""
+
+Rope output for template builders, for options.builder_output = 'rope'.
+
+A template builder then produces a Rope: the list of its pieces,
+where interpolated Ropes are kept as-is rather than converted to str.
+Nesting templates -- e.g. recursively -- thus copies nothing until the
+outermost Rope is turned into a str, or written out, once.
+
+"""
+
+
+class Rope:
+  """
+  A str (or bytes) made of pieces, which may themselves be Ropes.
+
+    str(rope), bytes(rope)   join all the pieces, once
+    rope.write(sink)         call sink.write() with each piece, in order
+    rope.pieces(), iter(rope)
+                             iterate over the pieces, in order, with nested
+                             Ropes flattened
+
+  Ropes compare equal to the str or bytes they represent.
+  """
+
+  __slots__ = ['parts']
+
+  def __init__(self, parts):
+    self.parts = parts
+
+  def __iter__(self):
+    return self.pieces()
+
+  def pieces(self):
+    """ Iterate over the pieces, in order, with nested Ropes flattened """
+
+    # Iterative, not recursive, so that deep trees do not hit the recursion limit
+    stack = [iter(self.parts)]
+    while stack:
+      for node in stack[-1]:
+        if type(node) is Rope:
+          stack.append(iter(node.parts))
+          break
+        yield node
+      else:
+        stack.pop()
+
+  def flatten(self):
+    """ Join all the pieces, giving a str or bytes """
+    pieces = list(self.pieces())
+    empty = b'' if pieces and isinstance(pieces[0], bytes) else ''
+    return empty.join(pieces)
+
+  def write(self, sink):
+    """ Write each piece to `sink`, e.g. a file, without joining them """
+    write = sink.write
+    for piece in self.pieces():
+      write(piece)
+
+  def __str__(self):
+    return ''.join(self.pieces())
+
+  def __bytes__(self):
+    return b''.join(self.pieces())
+
+  def __len__(self):
+    return sum(map(len, self.pieces()))
+
+  def __eq__(self, other):
+    if isinstance(other, Rope):
+      other = other.flatten()
+    return self.flatten() == other
+
+  def __hash__(self):
+    return hash(self.flatten())
+
+  def __add__(self, other):
+    return Rope([self, other])
+
+  def __radd__(self, other):
+    return Rope([other, self])
+
+  def __repr__(self):
+    return f"Rope({self.flatten()!r})"
+
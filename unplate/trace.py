@@ -0,0 +1,122 @@
+import contextlib
+import time
+
+"""
+
+Compiler instrumentation.
+
+  with unplate.trace.tracing(print):
+    exec(unplate.compile(__file__), globals(), locals())
+
+Each compilation done while tracing calls the callback with a CompileEvent
+describing how long each stage of the compiler took and which templates
+were compiled. Tracing is process-wide, i.e. it sees compilations in all
+threads. When nothing is tracing, the compiler only checks an empty list.
+
+"""
+
+# Active callbacks
+tracers = []
+
+
+@contextlib.contextmanager
+def tracing(callback):
+  """ Call `callback` with a CompileEvent for each compilation in this block """
+  tracers.append(callback)
+  try:
+    yield
+  finally:
+    tracers.remove(callback)
+
+
+def emit(event):
+  for tracer in list(tracers):
+    tracer(event)
+
+
+class RegionEvent:
+  """
+  Describes the compilation of a single template.
+
+    kind            'literal' or 'builder'
+    name            the name of the template, for builders; None for literals
+    lineno          the line the template starts on
+    lines           the number of source lines the template spans
+    tokens          the number of source tokens the template spans
+    compiled_tokens the number of tokens the template compiled to
+    duration        seconds taken to compile the template
+  """
+
+  def __init__(self, kind, name, lineno, lines, tokens, compiled_tokens, duration):
+    self.kind = kind
+    self.name = name
+    self.lineno = lineno
+    self.lines = lines
+    self.tokens = tokens
+    self.compiled_tokens = compiled_tokens
+    self.duration = duration
+
+  def as_dict(self):
+    return dict(vars(self))
+
+  def __repr__(self):
+    return f"RegionEvent({self.kind}, {self.name!r}, line {self.lineno}, {self.duration * 1000:.3f}ms)"
+
+
+class CompileEvent:
+  """
+  Describes the compilation of a single file (or string of code).
+
+    file_loc        the file compiled
+    stages          dict of stage name -> seconds, in the order the stages ran.
+                    Stages are 'read', 'tokenize', 'compile_top', 'replace_sublist',
+                    'untokenize' and 'builtins.compile'; not all are present
+                    for every entry point
+    tokens          the number of source tokens
+    regions         a RegionEvent for each template compiled
+    template_literals
+    template_builders
+                    the number of each kind of template
+    code_size       the length of the generated Python code
+  """
+
+  def __init__(self, file_loc):
+    self.file_loc = file_loc
+    self.stages = {}
+    self.tokens = 0
+    self.regions = []
+    self.code_size = 0
+    self.last_mark = time.perf_counter()
+
+  @property
+  def template_literals(self):
+    return sum(region.kind == 'literal' for region in self.regions)
+
+  @property
+  def template_builders(self):
+    return sum(region.kind == 'builder' for region in self.regions)
+
+  @property
+  def duration(self):
+    return sum(self.stages.values())
+
+  def stage(self, name):
+    """ Record that the stage `name` finished now, having started at the end of the last stage """
+    now = time.perf_counter()
+    self.stages[name] = now - self.last_mark
+    self.last_mark = now
+
+  def as_dict(self):
+    return {
+      'file_loc': self.file_loc,
+      'stages': dict(self.stages),
+      'duration': self.duration,
+      'tokens': self.tokens,
+      'template_literals': self.template_literals,
+      'template_builders': self.template_builders,
+      'code_size': self.code_size,
+      'regions': [region.as_dict() for region in self.regions],
+    }
+
+  def __repr__(self):
+    return f"CompileEvent({self.file_loc!r}, {self.duration * 1000:.3f}ms, {len(self.regions)} templates)"